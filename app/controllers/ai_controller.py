@@ -1,91 +1,205 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
 from fastapi.responses import StreamingResponse
-from services.ai_service import gemini_generate_review, deepseek_generate_review, qwen_generate_review, qwq_generate_review
+from services.ai_service import (
+    RUN_INSTRUCTION, SYSTEM_INSTRUCTION, build_run_prompt, cached_stream, generate_review, stream_review,
+    review_flights, validate_service, validate_size,
+)
+from controllers.judge0_controller import process_code_submission
+from services.ai_providers import registry
+from services.ai_routing import AUTO_SERVICE, routing_snapshot
+from services.review_cache import review_cache
+from services.incremental_review import stream_file_review, incremental_status
+from services.chat_sessions import chat_sessions, stream_chat, validate_message
+from firebase_client import get_async_db
 from models.code_model import CodeRequest
+from utils.sse import sse_event, SSE_HEADERS
+from utils.disconnect import cancel_on_disconnect
 import asyncio
-
-# Remove the duplicate import
-# import asyncio
+import time
+from typing import Optional
 
 async def get_available_services():
-    """Get list of available AI services."""
+    """Get list of available AI services with live health and latency stats."""
+    providers = registry.providers()
     return {
         "services": [
-            {"name": "gemini", "description": "Google's Gemini AI model"},
-            {"name": "deepseek", "description": "DeepSeek AI model"},
-            {"name": "qwen", "description": "Qwen AI model"},
-            {"name": "qwq", "description": "QwQ AI model"}
+            {"name": p.name, "description": p.description} for p in providers
+        ] + [
+            {"name": AUTO_SERVICE, "description": "Fastest healthy model, with hedging and fallback"}
         ],
-        "status": {
-            "gemini": "active",
-            "deepseek": "active",
-            "qwen-2.5": "active",
-            "qwq-32b": "active"
-        }
+        "status": {p.name: p.status() for p in providers},
+        "routing": routing_snapshot()
     }
 
-# Define streaming versions of the review functions
-async def gemini_generate_review_stream(code: str):
-    """Stream response from Gemini AI"""
-    response = await gemini_generate_review(code)
-    # Simulate streaming by yielding parts of the response
-    for i in range(0, len(response), 10):
-        yield response[i:i+10]
-        await asyncio.sleep(0.05)  # Small delay to simulate streaming
-
-async def deepseek_generate_review_stream(code: str):
-    """Stream response from DeepSeek AI"""
-    response = await deepseek_generate_review(code)
-    for i in range(0, len(response), 10):
-        yield response[i:i+10]
-        await asyncio.sleep(0.05)
-
-async def qwen_generate_review_stream(code: str):
-    """Stream response from Qwen AI"""
-    response = await qwen_generate_review(code)
-    for i in range(0, len(response), 10):
-        yield response[i:i+10]
-        await asyncio.sleep(0.05)
-
-async def qwq_generate_review_stream(code: str):
-    """Stream response from QWQ AI"""
-    response = await qwq_generate_review(code)
-    for i in range(0, len(response), 10):
-        yield response[i:i+10]
-        await asyncio.sleep(0.05)
-
-async def get_review_stream(code: str, service_choice: str):
-    """Stream the AI review response"""
+
+def _sse_review(deltas, service_choice: str, extra: Optional[dict] = None, request: Optional[Request] = None):
+    """
+    Wrap a delta stream as an SSE response with start/token/done events.
+    With a request, the stream (and the provider call behind it) is
+    cancelled as soon as the client disconnects.
+    """
+    extra = extra or {}
+
     async def generate():
+        started = time.perf_counter()
+        ttft_ms = None
         try:
-            if service_choice == "gemini":
-                async for chunk in gemini_generate_review_stream(code):
-                    yield chunk
-            elif service_choice == "deepseek":
-                async for chunk in deepseek_generate_review_stream(code):
-                    yield chunk
-            elif service_choice == "qwen-2.5":
-                async for chunk in qwen_generate_review_stream(code):
-                    yield chunk
-            elif service_choice == "qwq-32b":
-                async for chunk in qwq_generate_review_stream(code):
-                    yield chunk
-            else:
-                yield "Invalid service choice. Choose 'gemini', 'deepseek', 'qwen-2.5', or 'qwq-32b'."
+            async for delta in deltas:
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                    yield sse_event("start", {"service": service_choice, "ttft_ms": ttft_ms, **extra})
+                yield sse_event("token", {"delta": delta})
         except Exception as e:
-            yield f"Error: {str(e)}"
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+            yield sse_event("error", {"detail": str(e)})
+            return
+        yield sse_event("done", {
+            "service": service_choice,
+            "ttft_ms": ttft_ms,
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            **extra,
+        })
+
+    events = generate() if request is None else cancel_on_disconnect(request, generate())
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+async def get_review_stream(code: str, service_choice: str, request: Optional[Request] = None):
+    """Stream the AI review as SSE, forwarding provider deltas as they arrive."""
+    validate_service(service_choice)
+    validate_size(code)
+    return _sse_review(stream_review(code, service_choice), service_choice, request=request)
+
+
+async def get_file_review_stream(user_id: str, folder: str, filename: str, code: str, service_choice: str,
+                                 request: Optional[Request] = None):
+    """Stream an incremental review of a saved file as SSE."""
+    validate_service(service_choice)
+    validate_size(code)
+    return _sse_review(
+        stream_file_review(get_async_db(), user_id, folder, filename, code, service_choice), service_choice,
+        request=request,
+    )
+
+
+async def get_file_review(user_id: str, folder: str, filename: str, code: str, service_choice: str):
+    """Incremental review of a saved file (non-streaming version)"""
+    review = ""
+    async for delta in stream_file_review(get_async_db(), user_id, folder, filename, code, service_choice):
+        review += delta
+    return review
+
+async def get_chat_stream(user_id: str, session_id: str, message: str, service_choice: str,
+                          request: Optional[Request] = None):
+    """Stream one chat turn as SSE; the session id is in the start and done events."""
+    validate_service(service_choice)
+    validate_message(message)
+    return _sse_review(stream_chat(user_id, session_id, message, service_choice), service_choice,
+                       {"session_id": session_id}, request=request)
+
+
+async def get_chat(user_id: str, session_id: str, message: str, service_choice: str):
+    """One chat turn (non-streaming version)"""
+    answer = ""
+    async for delta in stream_chat(user_id, session_id, message, service_choice):
+        answer += delta
+    return answer
+
+
+async def end_chat(user_id: str, session_id: str) -> bool:
+    return await chat_sessions.delete((user_id, session_id))
+
+def run_failed(run: dict) -> bool:
+    """
+    A finished run that was not a clean Accepted one. When Judge0 itself
+    failed (unreachable, timed out, 503) there is nothing about the code
+    to explain, so no follow-up is sent.
+    """
+    if not run.get("success"):
+        return False
+    return (run.get("status") != "Accepted" or bool(run.get("stderr"))
+            or bool(run.get("compile_output")))
+
+
+async def get_run_and_review_stream(source_code: str, language_id: int, stdin: str, service_choice: str,
+                                    use_cache: bool = True, request: Optional[Request] = None):
+    """
+    Runs the code on Judge0 and reviews it at the same time, as one SSE stream.
+
+    Review deltas arrive as `token` events from the start. As soon as the
+    execution finishes a `run` event carries its result and, if it failed,
+    a second provider call explains the failure as `followup` events,
+    concurrently with the rest of the review. So the stream ends after
+    max(review, run + follow-up) instead of run + review.
+    """
+    validate_service(service_choice)
+    validate_size(source_code)
+
+    async def generate():
+        started = time.perf_counter()
+        events: asyncio.Queue = asyncio.Queue()
+        timings = {}
+
+        async def review():
+            try:
+                async for delta in stream_review(source_code, service_choice):
+                    if "review_ttft_ms" not in timings:
+                        timings["review_ttft_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                    events.put_nowait(("token", {"delta": delta}))
+            except Exception as e:
+                events.put_nowait(("error", {"detail": str(e), "part": "review"}))
+            timings["review_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        async def run_then_explain():
+            run = await process_code_submission(source_code, language_id, stdin, use_cache=use_cache)
+            timings["run_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            events.put_nowait(("run", run))
+            if not run_failed(run):
+                return
+            try:
+                async for delta in cached_stream(service_choice, SYSTEM_INSTRUCTION + RUN_INSTRUCTION,
+                                                 build_run_prompt(source_code, stdin, run)):
+                    events.put_nowait(("followup", {"delta": delta}))
+            except Exception as e:
+                events.put_nowait(("error", {"detail": str(e), "part": "followup"}))
+            timings["followup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        tasks = [asyncio.create_task(review()), asyncio.create_task(run_then_explain())]
+        finished = asyncio.gather(*tasks, return_exceptions=True)
+        finished.add_done_callback(lambda _: events.put_nowait(None))
+        yield sse_event("start", {"service": service_choice})
+        try:
+            while (event := await events.get()) is not None:
+                yield sse_event(*event)
+            for result in finished.result():
+                if isinstance(result, Exception):
+                    yield sse_event("error", {"detail": str(result)})
+        finally:
+            # Cancels the provider streams and abandons the Judge0 submission if the client left.
+            for task in tasks:
+                task.cancel()
+        yield sse_event("done", {
+            "service": service_choice,
+            **timings,
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        })
+
+    events = generate() if request is None else cancel_on_disconnect(request, generate())
+    return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
 
 async def get_review(code: str, service_choice: str):
     """Get AI review (non-streaming version)"""
-    if service_choice == "gemini":
-        return await gemini_generate_review(code)
-    elif service_choice == "deepseek":
-        return await deepseek_generate_review(code)
-    elif service_choice == "qwen-2.5":
-        return await qwen_generate_review(code)
-    elif service_choice == "qwq-32b":
-        return await qwq_generate_review(code)
-    else:
-        raise ValueError("Invalid service choice. Choose 'gemini', 'deepseek', 'qwen-2.5', or 'qwq-32b'.")
+    return await generate_review(code, service_choice)
+
+
+async def get_cache_stats():
+    """Hit/miss counters for the review cache and request coalescing."""
+    return {
+        **review_cache.snapshot(),
+        "coalescing": review_flights.snapshot(),
+        "incremental": incremental_status(),
+        "chat_sessions": chat_sessions.snapshot(),
+    }
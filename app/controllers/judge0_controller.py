@@ -1,12 +1,140 @@
-from services.judge0_service import submit_code
+from typing import AsyncIterator, Optional
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from models.code_model import BatchSubmission
+from services.judge0_service import (
+    build_payload, cached_result, create_batch, create_submission, get_submission,
+    is_finished, iter_batch_results, notify_finished, result_cache_status, store_result, submit_code,
+)
+from utils.sse import sse_event, SSE_HEADERS
+from utils.disconnect import cancel_on_disconnect
 
-def process_code_submission(source_code: str, language_id: int, stdin: str):
+
+def format_result(result: dict) -> dict:
+    """Shapes a raw Judge0 submission into the response the editor expects."""
+    status = result.get("status") or {}
+    return {
+        "output": result.get("stdout", ""),
+        "success": True,
+        "time": result.get("time", "N/A"),
+        "memory": result.get("memory"),
+        "stderr": result.get("stderr"),
+        "compile_output": result.get("compile_output"),
+        "status": status.get("description"),
+    }
+
+
+async def process_code_submission(source_code: str, language_id: int, stdin: str, use_cache: bool = True):
     """
     Processes a code submission and returns the result.
     """
-    result = submit_code(source_code, language_id, stdin)
+    result = await submit_code(source_code, language_id, stdin, use_cache=use_cache)
     
     if "error" in result:
         return {"success": False, "message": result["error"]}
     
-    return {"output": result.get("stdout", ""),"success": True, "time": result.get("time", "N/A")}
+    return format_result(result)
+
+
+async def start_code_submission(source_code: str, language_id: int, stdin: str):
+    """Enqueues a submission and returns its job token without waiting."""
+    token = await create_submission(source_code, language_id, stdin)
+    return {"token": token, "done": False}
+
+
+async def get_submission_result(token: str):
+    """Returns the job state; `done` is False while Judge0 is still queueing or running it."""
+    result = await get_submission(token)
+    if not is_finished(result):
+        status = result.get("status") or {}
+        return {"token": token, "done": False, "status": status.get("description")}
+    return {"token": token, "done": True, **format_result(result)}
+
+
+def handle_callback(payload: dict):
+    token = payload.get("token")
+    if token:
+        notify_finished(token)
+
+
+def format_case_result(index: int, result: dict, expected_output) -> dict:
+    """
+    Per-test-case verdict. Judge0 compares against expected_output itself
+    (status 3 Accepted / 4 Wrong Answer); without one, `passed` is None.
+    """
+    status = result.get("status") or {}
+    return {
+        "index": index,
+        "verdict": status.get("description"),
+        "passed": status.get("id") == 3 if expected_output is not None else None,
+        "stdout": result.get("stdout"),
+        "stderr": result.get("stderr"),
+        "compile_output": result.get("compile_output"),
+        "time": result.get("time"),
+        "memory": result.get("memory"),
+    }
+
+
+async def _run_batch(batch: BatchSubmission) -> AsyncIterator[dict]:
+    """Yields case results as they finish; cached cases come first and skip Judge0."""
+    use_cache = not batch.no_cache
+    payloads = [
+        build_payload(batch.source_code, batch.language_id, case.stdin, case.expected_output)
+        for case in batch.test_cases
+    ]
+    misses = []
+    for index, payload in enumerate(payloads):
+        cached = cached_result(payload, use_cache)
+        if cached is not None:
+            yield format_case_result(index, cached, batch.test_cases[index].expected_output)
+        else:
+            misses.append(index)
+    if not misses:
+        return
+
+    tokens = await create_batch([payloads[i] for i in misses])
+    async for position, result in iter_batch_results(tokens):
+        index = misses[position]
+        store_result(payloads[index], result, use_cache)
+        yield format_case_result(index, result, batch.test_cases[index].expected_output)
+
+
+def summarize(results: list) -> dict:
+    graded = [r for r in results if r["passed"] is not None]
+    return {
+        "total": len(results),
+        "passed": sum(1 for r in graded if r["passed"]),
+        "graded": len(graded),
+    }
+
+
+async def process_batch_submission(batch: BatchSubmission):
+    """Runs every test case through Judge0's batch API and returns all verdicts."""
+    results = [result async for result in _run_batch(batch)]
+    results.sort(key=lambda r: r["index"])
+    return {"success": True, "results": results, "summary": summarize(results)}
+
+
+async def stream_batch_submission(batch: BatchSubmission, request: Optional[Request] = None):
+    """
+    Streams each test case's verdict as an SSE event as soon as it finishes.
+    If the client disconnects, polling stops and the pending submissions are abandoned.
+    """
+
+    async def generate():
+        results = []
+        try:
+            async for result in _run_batch(batch):
+                results.append(result)
+                yield sse_event("case", result)
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+            return
+        yield sse_event("done", summarize(results))
+
+    events = generate() if request is None else cancel_on_disconnect(request, generate())
+    return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def get_result_cache_stats():
+    return result_cache_status()
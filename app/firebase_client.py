@@ -1,8 +1,8 @@
+import inspect
 import os
 import logging
+import time
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, firestore
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,10 +23,24 @@ FIREBASE_JSON_LOCATIONS = [
     os.getenv("FIREBASE_CREDENTIALS")  # Environment variable path
 ]
 
+# Nothing here runs at import time: the Admin SDK is imported and
+# initialized by init_firebase(), called from the app lifespan.
+firebase_status = {
+    "state": "pending",  # pending | ready | unconfigured | error
+    "credentials": None,
+    "error": None,
+    "init_ms": None,
+}
+
+
+class FirebaseUnavailable(Exception):
+    """Firebase has not been (or could not be) initialized."""
+
+
 def find_firebase_credentials():
     """
     Find Firebase credentials JSON file by checking multiple potential locations.
-    
+
     Returns:
         str: Path to the Firebase credentials file, or None if not found
     """
@@ -34,33 +48,105 @@ def find_firebase_credentials():
         try:
             # Expand any user path and convert to absolute path
             full_path = os.path.abspath(os.path.expanduser(path))
-            
+
             # Check if file exists
             if os.path.exists(full_path):
                 logger.info(f"Found Firebase credentials at: {full_path}")
                 return full_path
         except Exception as e:
             logger.debug(f"Error checking path {path}: {e}")
-    
+
     return None
 
-# Find Firebase credentials
-firebase_json = find_firebase_credentials()
-
-# Verify the JSON file exists
-if not firebase_json:
-    logger.error("Firebase JSON credentials not found")
-    logger.info("Searched locations:")
-    for loc in filter(None, FIREBASE_JSON_LOCATIONS):
-        logger.info(f"- {loc}")
-    raise FileNotFoundError("Could not locate Firebase JSON credentials")
-
-# Initialize Firebase
-try:
-    cred = credentials.Certificate(firebase_json)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
+
+def init_firebase() -> bool:
+    """
+    Find the credentials and initialize the Admin SDK. Blocking; run it
+    in a thread. Never raises: the outcome is recorded in firebase_status
+    so the worker still boots and reports itself not ready.
+    """
+    if firebase_status["state"] == "ready":
+        return True
+    started = time.perf_counter()
+    firebase_json = find_firebase_credentials()
+    if not firebase_json:
+        logger.error("Firebase JSON credentials not found")
+        logger.info("Searched locations:")
+        for loc in filter(None, FIREBASE_JSON_LOCATIONS):
+            logger.info(f"- {loc}")
+        firebase_status.update(state="unconfigured", error="Could not locate Firebase JSON credentials")
+        return False
+
+    try:
+        import firebase_admin
+        from firebase_admin import credentials
+
+        cred = credentials.Certificate(firebase_json)
+        firebase_admin.initialize_app(cred)
+    except Exception as e:
+        logger.error(f"Error initializing Firebase: {e}")
+        firebase_status.update(state="error", error=str(e))
+        return False
+    firebase_status.update(
+        state="ready",
+        credentials=firebase_json,
+        error=None,
+        init_ms=round((time.perf_counter() - started) * 1000, 1),
+    )
     logger.info("Firebase initialized successfully")
-except Exception as e:
-    logger.error(f"Error initializing Firebase: {e}")
-    raise
\ No newline at end of file
+    return True
+
+
+def firebase_ready() -> bool:
+    return firebase_status["state"] == "ready"
+
+
+# Async Firestore client, created once from the app lifespan.
+async_db = None
+
+
+def init_async_db():
+    """Create the shared async Firestore client."""
+    global async_db
+    if async_db is None:
+        if not firebase_ready():
+            raise FirebaseUnavailable(firebase_status["error"] or "Firebase is not initialized")
+        from firebase_admin import firestore_async
+
+        async_db = firestore_async.client()
+    return async_db
+
+
+def get_async_db():
+    """Return the shared async Firestore client."""
+    return async_db if async_db is not None else init_async_db()
+
+
+async def close_async_db():
+    global async_db
+    if async_db is not None:
+        result = async_db.close()
+        if inspect.isawaitable(result):
+            await result
+        async_db = None
+
+
+def server_timestamp():
+    """firestore.SERVER_TIMESTAMP, without importing Firestore until a write needs it."""
+    from google.cloud.firestore import SERVER_TIMESTAMP
+
+    return SERVER_TIMESTAMP
+
+
+def async_transactional(fn):
+    """google.cloud.firestore.async_transactional, imported on first use."""
+    from google.cloud.firestore import async_transactional as transactional
+
+    return transactional(fn)
+
+
+def field_path(*parts: str) -> str:
+    """Dotted Firestore field path, with each part quoted when it needs to be."""
+    from google.cloud.firestore import FieldPath
+
+    return FieldPath(*parts).to_api_repr()
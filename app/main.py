@@ -1,19 +1,68 @@
-from fastapi import FastAPI
+import asyncio
+import time
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from routes.judge0_route import router as judge0_router
 from routes.ai import router as ai_router
 from routes.auth_router import router as auth_router
 from routes.user_route import router as user_router
-from routes.files import router as files_router
+from routes.files import router as files_router, autosave
+from services.ai_providers import registry as ai_providers
+from services.review_cache import review_cache
+from services.cache import close_redis
+from services.chat_sessions import chat_sessions
+from services import judge0_service
+from services.rate_limit import start_limiters, stop_limiters, limiter_status
+from services.firebase_auth import signing_keys
+from services.ai_service import review_flights
+from services.metrics import MetricsMiddleware, render_metrics
+from utils.disconnect import disconnect_stats
+from firebase_client import (
+    FirebaseUnavailable, close_async_db, firebase_ready, firebase_status, init_async_db, init_firebase,
+)
 from contextlib import asynccontextmanager
 
+startup_status = {"started": False, "startup_ms": None}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create long-lived clients on startup and release them on shutdown.
 
+    Nothing here needs credentials to succeed: without Firebase the worker
+    still starts and /ready reports it as not ready.
+    """
+    started = time.perf_counter()
+    # Credential probing and Admin SDK setup touch the filesystem; keep them off the loop.
+    await asyncio.to_thread(init_firebase)
+    await ai_providers.start()
+    await review_cache.start()
+    await chat_sessions.start()
+    await judge0_service.start()
+    await start_limiters()
+    await signing_keys.start()
+    app.state.db = init_async_db() if firebase_ready() else None
+    app.state.ai_providers = ai_providers
+    startup_status.update(started=True, startup_ms=round((time.perf_counter() - started) * 1000, 1))
+    yield
+    await autosave.aclose()
+    await close_async_db()
+    await signing_keys.aclose()
+    await stop_limiters()
+    await judge0_service.aclose()
+    await chat_sessions.aclose()
+    await review_cache.aclose()
+    await close_redis()
+    await ai_providers.aclose()
 
 
 app = FastAPI(
     title="AI Powered Code Reviewer",
     description="An API for AI-powered code review and execution",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 
@@ -24,15 +73,59 @@ async def root():
     return {
         "status": "online",
         "message": "AI Code Reviewer API is running",
-        "available_services": ["gemini", "deepseek", "qwen-2.5"]
+        "available_services": ai_providers.names()
+    }
+
+@app.exception_handler(FirebaseUnavailable)
+async def firebase_unavailable(request: Request, exc: FirebaseUnavailable):
+    return JSONResponse(status_code=503, content={"detail": "Storage is not available yet"})
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once startup finished and Firebase is initialized, 503 before."""
+    is_ready = startup_status["started"] and firebase_ready()
+    body = {
+        "ready": is_ready,
+        **startup_status,
+        "firebase": firebase_status,
+        "providers": {
+            p.name: {"configured": p.configured, "loaded": p.loaded} for p in ai_providers.providers()
+        },
+        "signing_keys_fresh": signing_keys.fresh,
+    }
+    return JSONResponse(status_code=200 if is_ready else 503, content=body)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics: per-stage latency, TTFT, tokens/sec, Judge0 time/memory and in-flight gauges."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/limits")
+async def limits():
+    """Admission control counters and queue depth per limiter."""
+    return limiter_status()
+
+@app.get("/cancellations")
+async def cancellations():
+    """Work cancelled because the client went away, and what it had already cost."""
+    return {
+        "requests": disconnect_stats,
+        "coalesced_reviews": {k: review_flights.stats[k] for k in ("cancelled", "wasted_chars")},
+        "providers": {p.name: p.stats.cancelled for p in ai_providers.providers()},
+        "judge0": judge0_service.cancel_status(),
     }
 
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Not CORS-safelisted, so the editor could not read them without this.
+    expose_headers=["ETag", "Retry-After", "Server-Timing"],
 )
 
 app.include_router(ai_router, prefix="/ai", tags=["AI Review"])
@@ -1,10 +1,46 @@
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, Field
 
 class CodeRequest(BaseModel):
     code: str
     service_choice: str
 
+class FileReviewRequest(BaseModel):
+    folder: str
+    filename: str
+    service_choice: str
+    # Defaults to the saved content of the file.
+    code: Optional[str] = None
+
+class ChatRequest(BaseModel):
+    message: str
+    service_choice: str
+    # Omit to start a new session; the id is returned with the answer.
+    session_id: Optional[str] = Field(None, pattern=r"^[A-Za-z0-9_-]{1,64}$")
+
 class CodeSubmission(BaseModel):
     source_code: str
     language_id: int
     stdin: str = ""
+    # Skip the execution result cache (random, time- or IO-dependent programs).
+    no_cache: bool = False
+
+
+class RunReviewRequest(BaseModel):
+    source_code: str
+    language_id: int
+    service_choice: str
+    stdin: str = ""
+    no_cache: bool = False
+
+
+class TestCase(BaseModel):
+    stdin: str = ""
+    expected_output: Optional[str] = None
+
+
+class BatchSubmission(BaseModel):
+    source_code: str
+    language_id: int
+    test_cases: List[TestCase] = Field(min_length=1, max_length=100)
+    no_cache: bool = False
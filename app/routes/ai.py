@@ -1,8 +1,19 @@
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from typing import Optional
 from fastapi.responses import StreamingResponse
-from controllers.ai_controller import get_review, get_available_services
-from models.code_model import CodeRequest
+from controllers.ai_controller import (
+    get_review, get_review_stream, get_available_services, get_cache_stats,
+    get_file_review, get_file_review_stream, get_chat, get_chat_stream, end_chat, get_run_and_review_stream,
+)
+from models.code_model import ChatRequest, CodeRequest, FileReviewRequest, RunReviewRequest
+from services.chat_sessions import new_session_id, validate_message
+from routes.files import current_content
 from services.firebase_auth import verify_firebase_token
+from services.ai_providers import ProviderError
+from services.ai_routing import NoProviderAvailable
+from services.ai_service import review_is_cached, validate_service, validate_size
+from services.rate_limit import ai_limiter, caller_key, exec_limiter
+from utils.disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, run_until_disconnected
 
 router = APIRouter()
 
@@ -10,17 +21,169 @@ router = APIRouter()
 async def ai_service_status():
     """Check the status of AI services."""
     services = await get_available_services()
+    healthy = any(s["status"] == "active" for s in services["status"].values())
     return {
-        "status": "operational",
-        "available_services": services
+        "status": "operational" if healthy else "degraded",
+        "available_services": services,
+        "cache": await get_cache_stats()
     }
 
+
+@router.get("/cache/stats")
+async def review_cache_stats():
+    """Report review cache hit/miss counters."""
+    return await get_cache_stats()
+
+
+async def admit_ai(request: Request, user: dict, service_choice: str, code: Optional[str] = None,
+                   message: Optional[str] = None, cacheable: bool = False):
+    """
+    Admission control for AI routes. The request is validated first and a
+    review that is already cached is free, so neither a 400 nor a cache
+    hit spends the caller's AI budget.
+    """
+    try:
+        validate_service(service_choice)
+        if code is not None:
+            validate_size(code)
+        if message is not None:
+            validate_message(message)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cacheable and await review_is_cached(code, service_choice):
+        return
+    await ai_limiter.acquire(caller_key(request, user))
+
+
 @router.post("/get-review")
-async def review_code(payload: CodeRequest,
+async def review_code(payload: CodeRequest, request: Request,
                       user_data:dict=Depends(verify_firebase_token)):
     """Route to process AI code review."""
+    await admit_ai(request, user_data, payload.service_choice, code=payload.code, cacheable=True)
+    try:
+        review = await run_until_disconnected(request, get_review(payload.code, payload.service_choice))
+        return {"response": review}
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NoProviderAvailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ProviderError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@router.post("/get-review-stream")
+async def review_code_stream(payload: CodeRequest, request: Request,
+                             user_data:dict=Depends(verify_firebase_token)):
+    """Route to stream an AI code review as Server-Sent Events."""
+    await admit_ai(request, user_data, payload.service_choice, code=payload.code, cacheable=True)
+    try:
+        return await get_review_stream(payload.code, payload.service_choice, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def _file_code(payload: FileReviewRequest, user_id: str) -> str:
+    if payload.code is not None:
+        return payload.code
+    code = await current_content(user_id, payload.folder, payload.filename)
+    if code is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return code
+
+
+@router.post("/review-file")
+async def review_file(payload: FileReviewRequest, request: Request,
+                      user_data: dict = Depends(verify_firebase_token)):
+    """
+    Review a saved file. Re-reviews send only the lines changed since the
+    previous review of the same file and append the result to it.
+    """
+    code = await _file_code(payload, user_data["uid"])
+    await admit_ai(request, user_data, payload.service_choice, code=code)
     try:
-        review = await get_review(payload.code, payload.service_choice)
+        review = await run_until_disconnected(request, get_file_review(
+            user_data["uid"], payload.folder, payload.filename, code, payload.service_choice
+        ))
         return {"response": review}
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NoProviderAvailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ProviderError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@router.post("/review-file-stream")
+async def review_file_stream(payload: FileReviewRequest, request: Request,
+                             user_data: dict = Depends(verify_firebase_token)):
+    """Streaming version of /review-file, as Server-Sent Events."""
+    code = await _file_code(payload, user_data["uid"])
+    await admit_ai(request, user_data, payload.service_choice, code=code)
+    try:
+        return await get_file_review_stream(user_data["uid"], payload.folder, payload.filename,
+                                            code, payload.service_choice, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/chat")
+async def chat(payload: ChatRequest, request: Request, user_data: dict = Depends(verify_firebase_token)):
+    """
+    One turn of a multi-turn chat. The conversation is kept server-side,
+    so send only the new message and the session_id from the last answer.
+    """
+    await admit_ai(request, user_data, payload.service_choice, message=payload.message)
+    session_id = payload.session_id or new_session_id()
+    try:
+        answer = await run_until_disconnected(request, get_chat(
+            user_data["uid"], session_id, payload.message, payload.service_choice
+        ))
+        return {"response": answer, "session_id": session_id}
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NoProviderAvailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ProviderError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@router.post("/chat-stream")
+async def chat_stream(payload: ChatRequest, request: Request, user_data: dict = Depends(verify_firebase_token)):
+    """Streaming version of /chat, as Server-Sent Events."""
+    await admit_ai(request, user_data, payload.service_choice, message=payload.message)
+    session_id = payload.session_id or new_session_id()
+    try:
+        return await get_chat_stream(user_data["uid"], session_id, payload.message, payload.service_choice, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.delete("/chat/{session_id}")
+async def delete_chat(session_id: str, user_data: dict = Depends(verify_firebase_token)):
+    """End a chat session and drop its history."""
+    if not await end_chat(user_data["uid"], session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return {"message": "Chat session deleted."}
+
+
+@router.post("/run-and-review")
+async def run_and_review(payload: RunReviewRequest, request: Request,
+                         user_data: dict = Depends(verify_firebase_token)):
+    """
+    Execute the code and review it concurrently, as Server-Sent Events:
+    `token` (review), `run` (execution result), `followup` (why the run
+    failed, only when it did), then `done`.
+    """
+    await admit_ai(request, user_data, payload.service_choice, code=payload.source_code, cacheable=True)
+    await exec_limiter.acquire(caller_key(request, user_data))
+    try:
+        return await get_run_and_review_stream(payload.source_code, payload.language_id, payload.stdin,
+                                               payload.service_choice, not payload.no_cache, request)
     except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=str(e))
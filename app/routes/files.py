@@ -1,83 +1,244 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import Dict
-from firebase_admin import firestore
-from firebase_client import db
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import re
+from urllib.parse import quote
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.formparsers import MultiPartException, MultiPartParser
+from typing import Dict, Optional
+from firebase_client import async_transactional, get_async_db
+from services.firestore_bulk import delete_collection
+from services import project_index
+from services import project_archive
+from services.metrics import timed
+from services.autosave import AutosaveBuffer
+from services.file_store import PreconditionFailed, content_hash, etag_matches, write_file
 from routes.auth_router import get_current_user
 from models.file_model import FileContent, FolderCreate
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+# Fields the file tree needs; `content` is only ever returned by read_file.
+LISTING_FIELDS = ["filename", "last_modified", "size"]
+
+
+def user_doc(user_id: str):
+    return get_async_db().collection("users").document(user_id)
+
+
+def make_etag(digest: str) -> str:
+    return f'"{digest}"'
+
+
+def attachment_header(filename: str) -> str:
+    """
+    Content-Disposition for a download. Headers are latin-1, so the name
+    goes in an ASCII `filename` fallback plus an RFC 5987 `filename*`.
+    """
+    fallback = re.sub(r'[^\x20-\x7e]|["\\]', "_", filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+async def _flush_file(user_id: str, folder: str, filename: str, content: str) -> bool:
+    with timed("firestore_write"):
+        return await write_file(get_async_db(), user_id, folder, filename, content)
+
+
+# Coalesces rapid autosaves of the same file into one Firestore write.
+autosave = AutosaveBuffer(_flush_file)
+
+
+async def current_content(user_id: str, folder: str, filename: str) -> Optional[str]:
+    """Latest content of a file, including edits still in the autosave buffer; None if it does not exist."""
+    pending = autosave.get((user_id, folder, filename))
+    if pending is not None:
+        return pending.content
+    with timed("firestore_get"):
+        doc = await user_doc(user_id).collection(folder).document(filename).get(field_paths=["content"])
+    return (doc.to_dict() or {}).get("content", "") if doc.exists else None
+
+
 @router.post("/files/")
-async def create_file(file: FileContent, user: Dict = Depends(get_current_user)):
+async def create_file(file: FileContent, response: Response,
+                      if_match: Optional[str] = Header(None),
+                      user: Dict = Depends(get_current_user)):
+    """
+    Create or update a file.
+
+    Saves are buffered and written after a short debounce window, and
+    saves whose content hash equals the stored one are skipped. Send the
+    ETag from read_file as `If-Match` to write through immediately and get
+    412 when another tab changed the file in the meantime.
+    """
     user_id = user["uid"]
-    doc_ref = db.collection("users").document(user_id).collection(file.folder).document(file.filename)
-    doc_ref.set({
-        "content": file.content,
-        "filename": file.filename,
-        "folder": file.folder,
-        "last_modified": firestore.SERVER_TIMESTAMP
-    })
+    key = (user_id, file.folder, file.filename)
+    digest = content_hash(file.content)
+    response.headers["ETag"] = make_etag(digest)
+
+    if if_match is None and autosave.enabled:
+        pending = autosave.get(key)
+        if pending is not None and pending.hash == digest:
+            return {"message": f"File '{file.filename}' is unchanged.", "unchanged": True}
+        autosave.save(key, file.content)
+        return {"message": f"File '{file.filename}' created/updated successfully.", "buffered": True}
+
+    await autosave.flush_now(key)
+    try:
+        with timed("firestore_write"):
+            written = await write_file(get_async_db(), user_id, file.folder, file.filename, file.content, if_match)
+    except PreconditionFailed as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except project_index.IndexFull as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not written:
+        return {"message": f"File '{file.filename}' is unchanged.", "unchanged": True}
     return {"message": f"File '{file.filename}' created/updated successfully."}
 
 
 @router.get("/files/{folder}/{filename}")
-async def read_file(folder: str, filename: str, user: Dict = Depends(get_current_user)):
+async def read_file(folder: str, filename: str, response: Response,
+                    if_none_match: Optional[str] = Header(None),
+                    user: Dict = Depends(get_current_user)):
+    """Read a file. Returns an ETag; a matching If-None-Match gets 304 without the content."""
     user_id = user["uid"]
-    doc_ref = db.collection("users").document(user_id).collection(folder).document(filename)
-    doc = doc_ref.get()
+    pending = autosave.get((user_id, folder, filename))
+    if pending is not None:
+        # Unflushed edits are newer than Firestore.
+        if etag_matches(if_none_match, pending.hash):
+            return Response(status_code=304, headers={"ETag": make_etag(pending.hash)})
+        response.headers["ETag"] = make_etag(pending.hash)
+        return {
+            "content": pending.content,
+            "filename": filename,
+            "folder": folder,
+            "size": len(pending.content.encode("utf-8")),
+            "content_hash": pending.hash,
+        }
+
+    doc_ref = user_doc(user_id).collection(folder).document(filename)
+    if if_none_match:
+        # Fetch only the hash first so a 304 never transfers the content.
+        with timed("firestore_get"):
+            meta = await doc_ref.get(field_paths=["content_hash"])
+        if not meta.exists:
+            raise HTTPException(status_code=404, detail="File not found")
+        stored_hash = (meta.to_dict() or {}).get("content_hash")
+        if etag_matches(if_none_match, stored_hash):
+            return Response(status_code=304, headers={"ETag": make_etag(stored_hash)})
+    with timed("firestore_get"):
+        doc = await doc_ref.get()
     if not doc.exists:
         raise HTTPException(status_code=404, detail="File not found")
-    return doc.to_dict()
+    data = doc.to_dict()
+    response.headers["ETag"] = make_etag(data.get("content_hash") or content_hash(data.get("content", "")))
+    return data
+
+
+def encode_page_token(doc_id: str) -> str:
+    return base64.urlsafe_b64encode(doc_id.encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(token: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid page token")
 
 
 @router.get("/files/{folder}")
-async def list_files(folder: str, user: Dict = Depends(get_current_user)):
+async def list_files(folder: str,
+                     page_size: int = Query(100, ge=1, le=1000),
+                     page_token: Optional[str] = None,
+                     user: Dict = Depends(get_current_user)):
+    """
+    List file metadata (name, modification time, size) one page at a time.
+
+    Pass the returned `next_page_token` back as `page_token` for the next
+    page; it is null on the last page.
+    """
     user_id = user["uid"]
-    docs = db.collection("users").document(user_id).collection(folder).stream()
-    
+    query = (
+        user_doc(user_id).collection(folder)
+        .select(LISTING_FIELDS)
+        .order_by("__name__")
+        .limit(page_size)
+    )
+    if page_token:
+        query = query.start_after({"__name__": decode_page_token(page_token)})
+
+    with timed("firestore_list"):
+        docs = [doc async for doc in query.stream()]
+    next_page_token = encode_page_token(docs[-1].id) if len(docs) == page_size else None
+
     files = [{"filename": doc.id, **doc.to_dict()} for doc in docs if doc.id != ".marker"]
     
-    if not files:
+    if not files and not page_token and next_page_token is None:
         return {"message": f"No files found in folder '{folder}'"}
     
-    return {"files": files}
+    return {"files": files, "next_page_token": next_page_token}
 
 
 @router.delete("/files/{folder}/{filename}")
 async def delete_file(folder: str, filename: str, user: Dict = Depends(get_current_user)):
     user_id = user["uid"]
-    doc_ref = db.collection("users").document(user_id).collection(folder).document(filename)
-    
-    if not doc_ref.get().exists:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    doc_ref.delete()
+    db = get_async_db()
+    doc_ref = user_doc(user_id).collection(folder).document(filename)
+    key = (user_id, folder, filename)
+    buffered = autosave.get(key) is not None
+    autosave.discard(key)
+    await autosave.wait_flushing(key)
+    with timed("firestore_index"):
+        await project_index.ensure_index(db, user_id)
+
+    @async_transactional
+    async def remove(transaction):
+        if not (await doc_ref.get(transaction=transaction)).exists and not buffered:
+            raise HTTPException(status_code=404, detail="File not found")
+        index = await project_index.read_in_transaction(db, user_id, transaction)
+        transaction.delete(doc_ref)
+        project_index.drop_file(index, folder, filename)
+        project_index.write_in_transaction(db, user_id, transaction, index)
+
+    with timed("firestore_transaction"):
+        await remove(db.transaction())
     return {"message": f"File '{filename}' deleted successfully."}
 
 
 @router.post("/folders/")
 async def create_folder(folder: FolderCreate, user: Dict = Depends(get_current_user)):
     user_id = user["uid"]
-    
-    # Check if folder already exists
-    existing_folders = [col.id for col in db.collection("users").document(user_id).collections()]
-    if folder.folder_name in existing_folders:
-        raise HTTPException(status_code=400, detail="Folder already exists")
-    
-    # Create a marker document
-    doc_ref = db.collection("users").document(user_id).collection(folder.folder_name).document(".marker")
-    doc_ref.set({
-        "created": firestore.SERVER_TIMESTAMP,
-        "is_marker": True
-    })
-    
+    db = get_async_db()
+    with timed("firestore_index"):
+        await project_index.ensure_index(db, user_id)
+
+    @async_transactional
+    async def create(transaction):
+        index = await project_index.read_in_transaction(db, user_id, transaction)
+        # Check if folder already exists
+        if project_index.folder_exists(index, folder.folder_name):
+            raise HTTPException(status_code=400, detail="Folder already exists")
+        project_index.add_folder(index, folder.folder_name)
+        project_index.write_in_transaction(db, user_id, transaction, index)
+
+    try:
+        with timed("firestore_transaction"):
+            await create(db.transaction())
+    except project_index.IndexFull as e:
+        raise HTTPException(status_code=413, detail=str(e))
     return {"message": f"Folder '{folder.folder_name}' created successfully."}
 
 
 @router.get("/folders/")
 async def list_folders(user: Dict = Depends(get_current_user)):
     user_id = user["uid"]
-    folders = [col.id for col in db.collection("users").document(user_id).collections()]
+    with timed("firestore_index"):
+        index = await project_index.load_index(get_async_db(), user_id)
+    folders = list(index.get("folders", {}))
     
     if not folders:
         return {"message": "No folders found"}
@@ -85,14 +246,177 @@ async def list_folders(user: Dict = Depends(get_current_user)):
     return {"folders": folders}
 
 
+@router.get("/autosave/stats")
+async def autosave_stats():
+    """Write-behind queue depth and flush latency."""
+    return autosave.snapshot()
+
+
+@router.get("/folders/{folder}/export")
+async def export_folder(folder: str, user: Dict = Depends(get_current_user)):
+    """Download a folder as a zip archive, streamed while the files are read."""
+    user_id = user["uid"]
+    db = get_async_db()
+    await autosave.flush_folder(user_id, folder)
+    with timed("firestore_index"):
+        index = await project_index.load_index(db, user_id)
+    size = project_archive.folder_size(index, folder)
+    if size is None:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    if size > project_archive.ARCHIVE_MAX_EXPORT_BYTES:
+        raise HTTPException(status_code=413, detail="Folder is too large to export")
+    return StreamingResponse(
+        project_archive.export_folder(db, user_id, folder),
+        media_type="application/zip",
+        headers={"Content-Disposition": attachment_header(f"{folder}.zip")},
+    )
+
+
+# Room for the multipart boundaries and part headers around the archive.
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+async def _read_archive_upload(request: Request):
+    """
+    Parses the multipart body with a byte cap. Declaring an UploadFile
+    parameter would spool the whole body to disk before any check ran.
+    """
+    limit = project_archive.ARCHIVE_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail="Archive is too large")
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Send the archive as multipart/form-data")
+
+    too_large = False
+
+    async def capped():
+        nonlocal too_large
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                too_large = True
+                # The parser closes the files it spooled so far only on its own exception type.
+                raise MultiPartException("Archive is too large")
+            yield chunk
+
+    try:
+        form = await MultiPartParser(request.headers, capped(), max_files=1, max_fields=10).parse()
+    except MultiPartException as e:
+        raise HTTPException(status_code=413 if too_large else 400, detail=str(e))
+    archive = form.get("archive")
+    if archive is None or isinstance(archive, str):
+        await form.close()
+        raise HTTPException(status_code=400, detail="Missing 'archive' file")
+    return form, archive
+
+
+@router.post("/folders/{folder}/import", openapi_extra={"requestBody": {
+    "required": True,
+    "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "properties": {"archive": {"type": "string", "format": "binary"}},
+        "required": ["archive"],
+    }}},
+}})
+async def import_folder(folder: str, request: Request, user: Dict = Depends(get_current_user)):
+    """
+    Unpack a zip archive into a folder, creating it if needed.
+
+    Files at the top level of the archive (or of its single root
+    directory) become files in the folder; anything else is reported
+    under "skipped". Uploads over ARCHIVE_MAX_UPLOAD_MB are rejected
+    while they are being received.
+    """
+    user_id = user["uid"]
+    form, archive = await _read_archive_upload(request)
+    try:
+        # Write pending edits first, so none can land on top of the imported content.
+        await autosave.flush_folder(user_id, folder)
+        try:
+            result = await project_archive.import_folder(get_async_db(), user_id, folder, archive.file)
+        except project_archive.ArchiveError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        except project_index.IndexFull as e:
+            raise HTTPException(status_code=413, detail=str(e))
+    finally:
+        await form.close()
+    # Imported content replaces any edit still waiting in the autosave buffer.
+    for filename in result.pop("files"):
+        autosave.discard((user_id, folder, filename))
+    return {"message": f"Imported {result['written']} files into '{folder}'.", **result}
+
+
+@router.get("/archive/stats")
+async def archive_stats():
+    """Export/import counts and throughput."""
+    return project_archive.archive_status()
+
+
+@router.get("/tree/")
+async def project_tree(user: Dict = Depends(get_current_user)):
+    """Every folder with its file metadata (size, hash, mtime), from one document read."""
+    with timed("firestore_index"):
+        index = await project_index.load_index(get_async_db(), user["uid"])
+    return {"folders": index.get("folders", {})}
+
+
+async def _drop_folder_from_index(db, user_id: str, folder: str):
+    # Backfill first, or a pre-index user's tree would be replaced by an empty one.
+    with timed("firestore_index"):
+        await project_index.ensure_index(db, user_id)
+
+    @async_transactional
+    async def drop(transaction):
+        index = await project_index.read_in_transaction(db, user_id, transaction)
+        project_index.drop_folder(index, folder)
+        project_index.write_in_transaction(db, user_id, transaction, index)
+
+    with timed("firestore_transaction"):
+        await drop(db.transaction())
+
+
 @router.delete("/folders/{folder}")
-async def delete_folder(folder: str, user: Dict = Depends(get_current_user)):
+async def delete_folder(folder: str, progress: bool = False, user: Dict = Depends(get_current_user)):
+    """
+    Delete a folder and everything in it, including nested data.
+
+    With `?progress=true` the response is NDJSON: one {"deleted": n} line
+    per committed batch, then a final line with "done": true.
+    """
     user_id = user["uid"]
-    folder_ref = db.collection("users").document(user_id).collection(folder)
+    db = get_async_db()
+    folder_ref = user_doc(user_id).collection(folder)
+    autosave.discard_folder(user_id, folder)
+    # A flush that is already running would write its file (and folder) back after the delete.
+    await autosave.wait_flushing_folder(user_id, folder)
+
+    if not progress:
+        with timed("firestore_delete"):
+            deleted = await delete_collection(db, folder_ref)
+        await _drop_folder_from_index(db, user_id, folder)
+        logger.info(f"Deleted {deleted} documents from folder '{folder}'")
+        return {"message": f"Folder '{folder}' and all its contents deleted successfully.", "deleted": deleted}
+
+    async def stream_progress():
+        updates: asyncio.Queue = asyncio.Queue()
+
+        async def report(count: int):
+            await updates.put({"deleted": count})
 
-    # First, delete all files inside the folder
-    docs = folder_ref.stream()
-    for doc in docs:
-        doc.reference.delete()
+        task = asyncio.create_task(delete_collection(db, folder_ref, on_progress=report))
+        task.add_done_callback(lambda _: updates.put_nowait(None))
+        try:
+            while (update := await updates.get()) is not None:
+                yield json.dumps(update) + "\n"
+            deleted = task.result()
+            await _drop_folder_from_index(db, user_id, folder)
+        except Exception as e:
+            yield json.dumps({"error": str(e), "done": True}) + "\n"
+            return
+        finally:
+            task.cancel()
+        yield json.dumps({"deleted": deleted, "done": True}) + "\n"
 
-    return {"message": f"Folder '{folder}' and all its contents deleted successfully."}
+    return StreamingResponse(stream_progress(), media_type="application/x-ndjson")
@@ -1,10 +1,87 @@
-from fastapi import APIRouter, Depends
-from models.code_model import CodeSubmission
-from controllers.judge0_controller import process_code_submission
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from models.code_model import CodeSubmission, BatchSubmission
+from controllers.judge0_controller import (
+    process_code_submission, start_code_submission, get_submission_result, handle_callback,
+    process_batch_submission, stream_batch_submission, get_result_cache_stats,
+)
+import httpx
+from typing import Optional
+from services.judge0_service import Judge0Error, pool_status
+from services.firebase_auth import optional_firebase_user
+from services.rate_limit import caller_key, exec_limiter, limit_exec
+from utils.disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, run_until_disconnected
 
 router = APIRouter()
 
-@router.post("/run-code/")
-async def run_code(submission: CodeSubmission):
-    result = process_code_submission(submission.source_code, submission.language_id, submission.stdin)
-    return result
+@router.post("/run-code/", dependencies=[Depends(limit_exec)])
+async def run_code(submission: CodeSubmission, request: Request):
+    try:
+        return await run_until_disconnected(request, process_code_submission(
+            submission.source_code, submission.language_id, submission.stdin, use_cache=not submission.no_cache
+        ))
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+
+@router.post("/run-tests/")
+async def run_tests(batch: BatchSubmission, request: Request,
+                    user: Optional[dict] = Depends(optional_firebase_user)):
+    """
+    Run one program against many test cases and return every verdict.
+    Each test case costs one execution token, so a batch larger than the
+    per-user burst (RATE_LIMIT_EXEC_USER_BURST) is rejected with 413.
+    """
+    await exec_limiter.acquire(caller_key(request, user), cost=len(batch.test_cases))
+    try:
+        return await run_until_disconnected(request, process_batch_submission(batch))
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except (Judge0Error, httpx.HTTPError) as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@router.post("/run-tests/stream")
+async def run_tests_stream(batch: BatchSubmission, request: Request,
+                           user: Optional[dict] = Depends(optional_firebase_user)):
+    """Run one program against many test cases, streaming verdicts as they finish."""
+    await exec_limiter.acquire(caller_key(request, user), cost=len(batch.test_cases))
+    return await stream_batch_submission(batch, request)
+
+
+@router.post("/submissions/", status_code=202, dependencies=[Depends(limit_exec)])
+async def create_job(submission: CodeSubmission):
+    """Queue code for execution and return a job token to poll."""
+    try:
+        return await start_code_submission(submission.source_code, submission.language_id, submission.stdin)
+    except (Judge0Error, httpx.HTTPError) as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@router.put("/submissions/callback")
+async def judge0_callback(request: Request):
+    """Receives Judge0's completion callback (see JUDGE0_CALLBACK_URL)."""
+    handle_callback(await request.json())
+    return {"received": True}
+
+
+@router.get("/submissions/{token}")
+async def get_job(token: str):
+    """Poll the state of a queued execution."""
+    try:
+        return await get_submission_result(token)
+    except Judge0Error as e:
+        raise HTTPException(status_code=e.status_code if e.status_code == 404 else 502, detail=str(e))
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@router.get("/judge0/nodes")
+async def judge0_nodes():
+    """Health, queue depth and latency of every Judge0 node."""
+    return pool_status()
+
+
+@router.get("/judge0/cache")
+async def judge0_cache():
+    """Execution result cache counters."""
+    return get_result_cache_stats()
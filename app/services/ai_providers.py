@@ -0,0 +1,417 @@
+import asyncio
+import importlib
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+from services import metrics
+from services.review_chunking import CHARS_PER_TOKEN
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# SDKs are imported when a provider is first used; AI_PROVIDERS_PRELOAD=1
+# imports them and creates the clients during startup instead.
+AI_PROVIDERS_PRELOAD = os.getenv("AI_PROVIDERS_PRELOAD", "0") == "1"
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("AI_PROVIDER_MAX_CONCURRENCY", "8"))
+DEFAULT_MAX_CONNECTIONS = int(os.getenv("AI_PROVIDER_MAX_CONNECTIONS", "20"))
+
+# Health tracking
+EWMA_ALPHA = 0.2
+TTFT_WINDOW = 100
+UNHEALTHY_AFTER_FAILURES = 3
+UNHEALTHY_COOLDOWN = float(os.getenv("AI_PROVIDER_COOLDOWN", "30"))
+
+
+async def import_sdk(module_name: str):
+    """
+    Imports a provider SDK in a worker thread. A cold import of openai, groq
+    or google.generativeai takes long enough to stall every request on the loop.
+    """
+    return await asyncio.to_thread(importlib.import_module, module_name)
+
+
+class ProviderError(Exception):
+    """A provider failed to produce a review."""
+
+    def __init__(self, provider: str, message: str):
+        super().__init__(message)
+        self.provider = provider
+
+
+class ProviderStats:
+    """
+    Rolling latency and error statistics for one provider.
+
+    Latencies are exponentially weighted moving averages; the last
+    TTFT_WINDOW time-to-first-token samples are kept for percentiles.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.consecutive_failures = 0
+        self.ewma_latency_ms: Optional[float] = None
+        self.ewma_ttft_ms: Optional[float] = None
+        self.error_rate = 0.0
+        self.last_error: Optional[str] = None
+        self.unhealthy_until = 0.0
+        self._ttft_samples = deque(maxlen=TTFT_WINDOW)
+
+    @staticmethod
+    def _ewma(current: Optional[float], sample: float) -> float:
+        return sample if current is None else EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * current
+
+    def record_ttft(self, ttft_ms: float):
+        self.ewma_ttft_ms = self._ewma(self.ewma_ttft_ms, ttft_ms)
+        self._ttft_samples.append(ttft_ms)
+
+    def record_success(self, latency_ms: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.ewma_latency_ms = self._ewma(self.ewma_latency_ms, latency_ms)
+        self.error_rate = self._ewma(self.error_rate, 0.0)
+
+    def record_failure(self, error: BaseException):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = self._ewma(self.error_rate, 1.0)
+        self.last_error = str(error) or error.__class__.__name__
+        if self.consecutive_failures >= UNHEALTHY_AFTER_FAILURES:
+            self.unhealthy_until = time.monotonic() + UNHEALTHY_COOLDOWN
+
+    def record_cancelled(self):
+        self.cancelled += 1
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def ttft_percentile(self, percentile: float) -> Optional[float]:
+        if not self._ttft_samples:
+            return None
+        ordered = sorted(self._ttft_samples)
+        index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self) -> dict:
+        def rounded(value):
+            return None if value is None else round(value, 1)
+
+        return {
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "error_rate": round(self.error_rate, 4),
+            "ewma_latency_ms": rounded(self.ewma_latency_ms),
+            "ewma_ttft_ms": rounded(self.ewma_ttft_ms),
+            "p95_ttft_ms": rounded(self.ttft_percentile(95)),
+            "last_error": self.last_error,
+        }
+
+
+class Provider:
+    """
+    A long-lived connection to one LLM backend.
+
+    Subclasses own their SDK client and translate a chat (system + user
+    message) into a stream of text deltas. Every stream holds one slot of
+    the provider's semaphore for its whole duration, so a slow backend can
+    only ever tie up `max_concurrency` of our requests.
+    """
+
+    def __init__(self, name: str, label: str, description: str, model: str,
+                 api_key_env: str, max_concurrency: Optional[int] = None):
+        self.name = name
+        self.label = label
+        self.description = description
+        self.model = model
+        self.api_key_env = api_key_env
+        self.max_concurrency = max_concurrency or _env_int(
+            f"AI_MAX_CONCURRENCY_{_env_suffix(name)}", DEFAULT_MAX_CONCURRENCY
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Held while the SDK is imported and the client created, so concurrent first uses do it once.
+        self._start_lock = asyncio.Lock()
+        self._in_flight = 0
+        self.stats = ProviderStats()
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return os.getenv(self.api_key_env)
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def available(self) -> bool:
+        return self.configured and self.stats.healthy
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the SDK client has been created."""
+        return False
+
+    def status(self) -> dict:
+        state = "unconfigured" if not self.configured else ("active" if self.stats.healthy else "degraded")
+        return {
+            "status": state,
+            "loaded": self.loaded,
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            **self.stats.snapshot(),
+        }
+
+    async def start(self):
+        """Import the SDK and create the client. Called on first use, or from the lifespan when preloading."""
+
+    async def aclose(self):
+        """Release pooled connections. Called once on shutdown."""
+
+    async def _stream(self, system: str, user: str) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    async def stream(self, system: str, user: str) -> AsyncIterator[str]:
+        """
+        Yield response deltas, bounded by the provider's concurrency limit.
+
+        Latency, time-to-first-token and failures are recorded in `stats`;
+        provider exceptions are re-raised as ProviderError.
+        """
+        if not self.configured:
+            raise ValueError(f"{self.label} API key is missing! Set {self.api_key_env} as an environment variable.")
+        # Queueing for a slot counts towards latency so routing sees saturation.
+        started = time.perf_counter()
+        async with self._semaphore:
+            sent = time.perf_counter()
+            metrics.PROVIDER_QUEUE_SECONDS.labels(self.name).observe(sent - started)
+            in_flight = metrics.PROVIDER_IN_FLIGHT.labels(self.name)
+            in_flight.inc()
+            self._in_flight += 1
+            first_at = None
+            chars = 0
+            outcome = "error"
+            try:
+                async for delta in self._stream(system, user):
+                    if first_at is None:
+                        first_at = time.perf_counter()
+                        self.stats.record_ttft((first_at - started) * 1000)
+                        metrics.PROVIDER_TTFT_SECONDS.labels(self.name).observe(first_at - sent)
+                        metrics.add_timing("ttft", first_at - started)
+                    chars += len(delta)
+                    yield delta
+            except (asyncio.CancelledError, GeneratorExit):
+                outcome = "cancelled"
+                self.stats.record_cancelled()
+                raise
+            except Exception as e:
+                self.stats.record_failure(e)
+                raise ProviderError(self.name, f"Failed to generate review in {self.label}: {e}") from e
+            else:
+                outcome = "ok"
+                self.stats.record_success((time.perf_counter() - started) * 1000)
+            finally:
+                self._in_flight -= 1
+                in_flight.dec()
+                finished = time.perf_counter()
+                metrics.PROVIDER_SECONDS.labels(self.name, outcome).observe(finished - sent)
+                if first_at is not None and finished > first_at and outcome == "ok":
+                    tokens = chars / CHARS_PER_TOKEN
+                    metrics.PROVIDER_TOKENS_PER_SECOND.labels(self.name).observe(tokens / (finished - first_at))
+
+
+class OpenAICompatibleProvider(Provider):
+    """Provider for OpenAI-style chat completion APIs (OpenRouter, Groq)."""
+
+    def __init__(self, *args, base_url: Optional[str] = None, client_cls: str = "openai.AsyncOpenAI", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url = base_url
+        # Dotted path, so the SDK is only imported when the client is created.
+        self.client_cls = client_cls
+        self._http: Optional[httpx.AsyncClient] = None
+        self._client = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._client is not None
+
+    async def start(self):
+        if not self.configured or self._client is not None:
+            return
+        async with self._start_lock:
+            if self._client is not None:
+                return
+            module_name, _, class_name = self.client_cls.rpartition(".")
+            client_cls = getattr(await import_sdk(module_name), class_name)
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=DEFAULT_MAX_CONNECTIONS,
+                    max_keepalive_connections=DEFAULT_MAX_CONNECTIONS,
+                    keepalive_expiry=60,
+                ),
+                timeout=httpx.Timeout(120.0, connect=10.0),
+            )
+            kwargs = {"api_key": self.api_key, "http_client": self._http}
+            if self.base_url:
+                kwargs["base_url"] = self.base_url
+            self._client = client_cls(**kwargs)
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+        self._http = None
+        self._client = None
+
+    async def _stream(self, system: str, user: str) -> AsyncIterator[str]:
+        if self._client is None:
+            await self.start()
+        response = await self._client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": user}
+            ],
+            stream=True
+        )
+        # Closing the response on cancellation drops the connection, which stops generation upstream.
+        async with response:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+
+class GeminiProvider(Provider):
+    """Provider for Google Gemini through google-generativeai's async transport."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._model = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    async def start(self):
+        if not self.configured or self._model is not None:
+            return
+        async with self._start_lock:
+            if self._model is not None:
+                return
+            genai = await import_sdk("google.generativeai")
+            genai.configure(api_key=self.api_key)
+            self._model = genai.GenerativeModel(self.model)
+
+    async def aclose(self):
+        self._model = None
+
+    async def _stream(self, system: str, user: str) -> AsyncIterator[str]:
+        if self._model is None:
+            await self.start()
+        prompt = f"{system}\n\n{user}"
+        response = await self._model.generate_content_async([prompt], stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+
+class ProviderRegistry:
+    """Name -> Provider lookup shared by the whole application."""
+
+    def __init__(self):
+        self._providers: Dict[str, Provider] = {}
+
+    def register(self, provider: Provider):
+        self._providers[provider.name] = provider
+
+    def get(self, name: str) -> Provider:
+        provider = self._providers.get(name)
+        if provider is None:
+            raise ValueError(f"Invalid service choice. Choose {self.choices()}.")
+        return provider
+
+    def names(self) -> List[str]:
+        return list(self._providers)
+
+    def providers(self) -> List[Provider]:
+        return list(self._providers.values())
+
+    def ranked(self) -> List[Provider]:
+        """
+        Available providers, fastest first.
+
+        Measured providers come first, scored by their EWMA
+        time-to-first-token inflated by the error rate. Untried providers
+        follow, so they are probed as the hedge of a slow leader rather
+        than holding up requests as the leader themselves. Providers that
+        have only ever failed come last.
+        """
+        def score(provider: Provider) -> Tuple[int, float]:
+            ttft = provider.stats.ewma_ttft_ms
+            if ttft is not None:
+                return 0, ttft * (1 + 4 * provider.stats.error_rate)
+            if provider.stats.failures == 0:
+                return 1, 0.0
+            return 2, provider.stats.error_rate
+
+        return sorted((p for p in self._providers.values() if p.available), key=score)
+
+    def choices(self, *extra: str) -> str:
+        """Quoted provider names (plus any `extra` modes) for error messages."""
+        quoted = [f"'{name}'" for name in [*self._providers, *extra]]
+        return ", ".join(quoted[:-1]) + f", or {quoted[-1]}" if len(quoted) > 1 else "".join(quoted)
+
+    async def start(self):
+        if AI_PROVIDERS_PRELOAD:
+            await asyncio.gather(*(provider.start() for provider in self._providers.values()))
+
+    async def aclose(self):
+        await asyncio.gather(*(provider.aclose() for provider in self._providers.values()),
+                             return_exceptions=True)
+
+
+def _env_suffix(name: str) -> str:
+    return name.upper().replace("-", "_").replace(".", "_")
+
+
+def _env_int(key: str, default: int) -> int:
+    value = os.getenv(key)
+    return int(value) if value else default
+
+
+def build_registry() -> ProviderRegistry:
+    """Create the registry with every backend the reviewer supports."""
+    providers = ProviderRegistry()
+    providers.register(GeminiProvider(
+        "gemini", "Gemini", "Google's Gemini AI model",
+        model="gemini-1.5-flash", api_key_env="GEMINI_API_KEY",
+    ))
+    providers.register(OpenAICompatibleProvider(
+        "deepseek", "DeepSeek", "DeepSeek AI model",
+        model="deepseek/deepseek-r1:free", api_key_env="DEEPSEEK_API_KEY",
+        base_url=OPENROUTER_BASE_URL,
+    ))
+    providers.register(OpenAICompatibleProvider(
+        "qwen-2.5", "Qwen", "Qwen AI model",
+        model="qwen-2.5-coder-32b", api_key_env="GROQ_API_KEY",
+        client_cls="groq.AsyncGroq",
+    ))
+    providers.register(OpenAICompatibleProvider(
+        "qwq-32b", "QwQ", "QwQ AI model",
+        model="anthropic/claude-3-opus:free",  # Using Claude 3 Opus via OpenRouter for QwQ
+        api_key_env="OPENROUTER_API_KEY", base_url=OPENROUTER_BASE_URL,
+    ))
+    return providers
+
+
+registry = build_registry()
@@ -0,0 +1,135 @@
+import asyncio
+import os
+from typing import AsyncIterator, List, Optional
+
+from services.ai_providers import Provider, ProviderError, ProviderRegistry
+
+AUTO_SERVICE = "auto"
+
+HEDGE_PERCENTILE = 95
+HEDGE_DEFAULT_DELAY = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "3.0"))
+HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_DELAY = float(os.getenv("AI_HEDGE_MAX_DELAY", "10.0"))
+
+_END = object()
+
+routing_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "fallbacks": 0}
+
+
+class NoProviderAvailable(ProviderError):
+    """Every candidate provider is unconfigured, unhealthy or failed."""
+
+    def __init__(self, message: str):
+        super().__init__(AUTO_SERVICE, message)
+
+
+def hedge_delay(provider: Provider) -> float:
+    """Seconds to wait for a first token before hedging to another provider."""
+    p95 = provider.stats.ttft_percentile(HEDGE_PERCENTILE)
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p95 / 1000))
+
+
+class _Attempt:
+    """Runs one provider stream in a task and buffers its deltas."""
+
+    def __init__(self, provider: Provider, system: str, user: str):
+        self.provider = provider
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.first: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._run(system, user))
+
+    async def _run(self, system: str, user: str):
+        try:
+            async for delta in self.provider.stream(system, user):
+                if not self.first.done():
+                    self.first.set_result(delta)
+                else:
+                    await self.queue.put(delta)
+            if not self.first.done():
+                self.first.set_exception(
+                    ProviderError(self.provider.name, f"{self.provider.label} returned an empty response")
+                )
+            await self.queue.put(_END)
+        except Exception as e:
+            if not self.first.done():
+                self.first.set_exception(e)
+            else:
+                await self.queue.put(e)
+
+    @property
+    def failed(self) -> bool:
+        return self.first.done() and not self.first.cancelled() and self.first.exception() is not None
+
+    def cancel(self):
+        self.task.cancel()
+        if not self.first.done():
+            self.first.cancel()
+
+
+async def stream_auto(registry: ProviderRegistry, system: str, user: str) -> AsyncIterator[str]:
+    """
+    Stream from the fastest healthy provider, hedging when it is slow.
+
+    Providers are tried in `registry.ranked()` order, so while a measured
+    provider is available an untried one is only started as a hedge. If
+    the current leader has not produced a first token within its
+    p95-based hedge delay, the next provider is started as well; the
+    first one to emit a token wins and the other is cancelled. A provider
+    that fails before its first token is replaced by the next candidate.
+    Once a token has been sent, the stream is committed to that provider.
+    """
+    candidates: List[Provider] = registry.ranked()
+    if not candidates:
+        raise NoProviderAvailable("No healthy AI provider is available.")
+    routing_stats["requests"] += 1
+
+    attempts: List[_Attempt] = []
+    winner: Optional[_Attempt] = None
+    hedged = False
+    try:
+        attempts.append(_Attempt(candidates.pop(0), system, user))
+        while winner is None:
+            live = [a for a in attempts if not a.failed]
+            if not live:
+                if not candidates:
+                    raise NoProviderAvailable(
+                        "All AI providers failed: " + "; ".join(str(a.first.exception()) for a in attempts)
+                    )
+                routing_stats["fallbacks"] += 1
+                attempts.append(_Attempt(candidates.pop(0), system, user))
+                continue
+
+            timeout = hedge_delay(live[-1].provider) if candidates and len(live) == 1 else None
+            await asyncio.wait([a.first for a in live], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in live:
+                if attempt.first.done() and not attempt.failed:
+                    winner = attempt
+                    break
+            if winner is None and not any(a.first.done() for a in live):
+                routing_stats["hedged"] += 1
+                hedged = True
+                attempts.append(_Attempt(candidates.pop(0), system, user))
+
+        if hedged and winner is attempts[-1]:
+            routing_stats["hedge_wins"] += 1
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+
+        yield winner.first.result()
+        while True:
+            item = await winner.queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+
+def routing_snapshot() -> dict:
+    return dict(routing_stats)
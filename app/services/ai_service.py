@@ -1,8 +1,16 @@
-import google.generativeai as genai
+import asyncio
+import hashlib
 import os
+from typing import AsyncIterator, Optional
 from dotenv import load_dotenv
-from openai import OpenAI
-from groq import Groq
+from services.ai_providers import ProviderError, registry
+from services.ai_routing import AUTO_SERVICE, stream_auto
+from services import metrics
+from services.review_cache import review_cache, review_key
+from services.singleflight import StreamSingleFlight
+from services.review_chunking import (
+    REVIEW_CHUNK_TOKENS, REVIEW_MAX_INPUT_TOKENS, Chunk, estimate_tokens, outline, split_code
+)
 load_dotenv()
 
 
@@ -18,126 +26,240 @@ note:1) always keep the class in java code as Main
 
 
 
-# Gemini function
-async def gemini_generate_review(code: str) -> str:
-    """Calls Gemini API to analyze and review code."""
+CHUNK_INSTRUCTION = """
+The code you are given is one part of a larger file that is being reviewed in parts at the same time.
+Review only this part. Names that are not defined here are probably defined in another part (see the outline), so do not report them as missing.
+Do not repeat the whole code back; quote only the lines you change.
+"""
 
-    # GEMINI
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    if not GEMINI_API_KEY:
-        raise ValueError("Gemini API key is missing! Set GEMINI_API_KEY as an environment variable.")
+INCREMENTAL_INSTRUCTION = """
+You reviewed an earlier version of this file before. You are now given only the changes since then, as a unified diff with a few lines of context.
+Review only the changed lines: say whether they fix the problems they seem to address, and point out anything they break or introduce.
+Do not re-review unchanged code and do not repeat the whole file.
+"""
 
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemni_model = genai.GenerativeModel("gemini-1.5-flash")
+RUN_INSTRUCTION = """
+The code below was just executed on Judge0 and did not run cleanly. You are given the status and the program's stdout, stderr and compiler output.
+Explain briefly why it fails, point to the responsible lines and show the fix. A separate review of the code is shown to the user already, so do not review anything unrelated to this failure.
+"""
 
+# Part of every review cache key, so editing the prompt invalidates old reviews.
+PROMPT_VERSION = hashlib.sha256(
+    (SYSTEM_INSTRUCTION + CHUNK_INSTRUCTION + INCREMENTAL_INSTRUCTION + RUN_INSTRUCTION).encode("utf-8")
+).hexdigest()[:12]
 
-    try:
-        prompt = f"{SYSTEM_INSTRUCTION}\n\nUser question: {code}"
-        response = gemni_model.generate_content([prompt])
-        return response.text
-    except Exception as e:
-        print(f"Error in generating the review in Gemini: {e}")
-        return "Failed to generate review in Gemini."
+# Longest stdout/stderr/compile output quoted back to the model.
+RUN_OUTPUT_MAX_CHARS = 4000
 
+# Most chunks of one large file reviewed at once. The default covers every
+# chunk of the largest accepted input; REVIEW_CHUNK_SLOT_SHARE still applies.
+REVIEW_CHUNK_CONCURRENCY = int(os.getenv(
+    "REVIEW_CHUNK_CONCURRENCY", str(2 * -(-REVIEW_MAX_INPUT_TOKENS // REVIEW_CHUNK_TOKENS))
+))
+# Share of a provider's AI_MAX_CONCURRENCY_* slots one chunked review may
+# hold, so a large file cannot starve everyone else's reviews.
+REVIEW_CHUNK_SLOT_SHARE = float(os.getenv("REVIEW_CHUNK_SLOT_SHARE", "0.5"))
 
-# Update the qwen_generate_review function to use streaming
-async def qwen_generate_review(code: str) -> str:
-    """Calls Qwen API to analyze and review code."""
 
-    # GEMINI
-    GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-    if not GROQ_API_KEY:
-        raise ValueError("GROQ API key is missing! Set GROQ_API_KEY as an environment variable.")
+# Identical concurrent reviews share one provider call.
+review_flights = StreamSingleFlight()
 
-    client=Groq(api_key=GROQ_API_KEY)
 
-    try:
-        user_content = f"User question: {code}"
-            
-        response = client.chat.completions.create(
-            messages = [
-                {"role": "system", "content": SYSTEM_INSTRUCTION},
-                {"role": "user", "content": user_content}
-            ],
-            model="qwen-2.5-coder-32b",
-            stream=True
-        )
-        
-        full_response = ""
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                full_response += chunk.choices[0].delta.content
-        
-        return full_response
-    except Exception as e:
-        print(f"Error in generating the review in Qwen: {e}")
-        return "Failed to generate review in Qwen."
-
-# Update the deepseek_generate_review function to use streaming
-async def deepseek_generate_review(code: str) -> str:
-    """Calls DeepSeek API to analyze and review code."""
-    # DeepSeek
-    DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-    if not DEEPSEEK_API_KEY:
-        raise ValueError("Deepseek API key is missing!")
-
-    client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://openrouter.ai/api/v1")
+def build_user_prompt(code: str) -> str:
+    return f"User question: {code}"
+
+
+def build_chunk_prompt(chunk: Chunk, total: int, file_outline: str) -> str:
+    return (
+        f"Part {chunk.index + 1} of {total} (lines {chunk.start_line}-{chunk.end_line}).\n"
+        f"Outline of the whole file:\n{file_outline}\n\n"
+        f"Code:\n{chunk.text}"
+    )
+
+
+def build_run_prompt(code: str, stdin: str, run: dict) -> str:
+    def clip(text) -> str:
+        text = text or ""
+        return text if len(text) <= RUN_OUTPUT_MAX_CHARS else text[:RUN_OUTPUT_MAX_CHARS] + "\n...(truncated)"
+
+    return (
+        f"Code:\n{code}\n\n"
+        f"stdin:\n{clip(stdin)}\n\n"
+        f"Status: {run.get('status') or run.get('message')}\n"
+        f"stdout:\n{clip(run.get('output'))}\n\n"
+        f"stderr:\n{clip(run.get('stderr'))}\n\n"
+        f"compile output:\n{clip(run.get('compile_output'))}"
+    )
+
+
+def validate_service(service_choice: str):
+    """Raise ValueError unless service_choice names a provider or 'auto'."""
+    if service_choice != AUTO_SERVICE and service_choice not in registry.names():
+        raise ValueError(f"Invalid service choice. Choose {registry.choices(AUTO_SERVICE)}.")
+
+
+def validate_size(code: str):
+    """Raise ValueError when the code is over the review token budget."""
+    tokens = estimate_tokens(code)
+    if tokens > REVIEW_MAX_INPUT_TOKENS:
+        raise ValueError(f"Code is too large to review (~{tokens} tokens, limit {REVIEW_MAX_INPUT_TOKENS})")
+
+
+def chunk_slots(service_choice: str) -> int:
+    """Provider slots one chunked review may hold at once."""
+    if service_choice == AUTO_SERVICE:
+        candidates = registry.ranked()
+        slots = candidates[0].max_concurrency if candidates else 1
+    else:
+        slots = registry.get(service_choice).max_concurrency
+    return max(1, int(slots * REVIEW_CHUNK_SLOT_SHARE))
+
+
+async def lookup_review(key: str):
+    """Review cache read, timed and counted as a hit or a miss."""
+    with metrics.timed("review_cache"):
+        cached = await review_cache.get(key)
+    metrics.REVIEW_CACHE_LOOKUPS.labels("hit" if cached is not None else "miss").inc()
+    return cached
 
-    try:
 
-        user_content = f"User question: {code}"
-            
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-r1:free",
-            messages = [
-                {"role": "system", "content": SYSTEM_INSTRUCTION},
-                {"role": "user", "content": user_content}
-            ],
-            stream=True  # Enable streaming
-        )
-        
+def full_review_key(code: str, service_choice: str) -> str:
+    """Cache key of the whole review stream_review produces for this code."""
+    if estimate_tokens(code) > REVIEW_CHUNK_TOKENS:
+        return review_key(code, service_choice, PROMPT_VERSION + ":chunked")
+    return review_key(build_user_prompt(code), service_choice, PROMPT_VERSION)
+
+
+async def review_is_cached(code: str, service_choice: str) -> bool:
+    """Whether stream_review would be answered from the cache; not counted as a lookup."""
+    return await review_cache.prefetch(full_review_key(code, service_choice))
+
+
+def provider_stream(service_choice: str, system: str, user: str) -> AsyncIterator[str]:
+    """Delta stream from the named provider, or from the latency-aware router for 'auto'."""
+    if service_choice == AUTO_SERVICE:
+        return stream_auto(registry, system, user)
+    return registry.get(service_choice).stream(system, user)
+
+
+async def cached_stream(service_choice: str, system: str, user: str,
+                        key: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Provider deltas for one prompt, served from the review cache when
+    possible. Concurrent identical prompts attach to one in-flight
+    provider call, and only completed responses are stored. `key`
+    defaults to a hash of the prompt.
+    """
+    key = key or review_key(user, service_choice, PROMPT_VERSION)
+    cached = await lookup_review(key)
+    if cached is not None:
+        yield cached
+        return
+
+    async def produce():
         full_response = ""
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                full_response += chunk.choices[0].delta.content
-        
-        return full_response
-    except Exception as e:
-        print(f"Error in generating the review in DeepSeek: {e}")
-        return "Failed to generate review in DeepSeek."
-
-# Add this function after the qwen_generate_review function
-
-async def qwq_generate_review(code: str) -> str:
-    """Calls QwQ openrouter API to analyze and review code."""
-    
-    # QwQ openrouter
-    OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-    if not OPENROUTER_API_KEY:
-        raise ValueError("OpenRouter API key is missing! Set OPENROUTER_API_KEY as an environment variable.")
-
-    client = OpenAI(api_key=OPENROUTER_API_KEY, base_url="https://openrouter.ai/api/v1")
+        async for delta in provider_stream(service_choice, system, user):
+            full_response += delta
+            yield delta
+        if full_response:
+            await review_cache.set(key, full_response)
+
+    async for delta in review_flights.subscribe(key, produce):
+        yield delta
+
+
+async def stream_chunked_review(code: str, service_choice: str) -> AsyncIterator[str]:
+    """
+    Map-reduce review of a large file.
 
+    The code is split at function/class boundaries into chunks of at most
+    REVIEW_CHUNK_TOKENS, and up to REVIEW_CHUNK_CONCURRENCY chunks are
+    reviewed at once, but never on more than REVIEW_CHUNK_SLOT_SHARE of
+    the provider's concurrency slots. Sections are merged in line order:
+    the earliest unfinished chunk streams live, and later chunks that
+    finished first are flushed as soon as it completes. While every chunk
+    gets a slot the whole review takes about as long as the slowest
+    chunk; beyond that, chunks run in waves.
+
+    Each chunk is cached by its own text rather than by its prompt, which
+    also carries the whole-file outline and the chunk's line range. So
+    editing one function only re-reviews the chunks whose text changed.
+    The merged review is cached only when every chunk succeeded.
+    """
+    key = full_review_key(code, service_choice)
+    cached = await lookup_review(key)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = split_code(code)
+    file_outline = outline(code)
+    system = SYSTEM_INSTRUCTION + CHUNK_INSTRUCTION
+    semaphore = asyncio.Semaphore(max(1, min(len(chunks), REVIEW_CHUNK_CONCURRENCY, chunk_slots(service_choice))))
+    queues = [asyncio.Queue() for _ in chunks]
+    done = object()
+
+    async def review_chunk(chunk: Chunk, queue: asyncio.Queue):
+        try:
+            async with semaphore:
+                prompt = build_chunk_prompt(chunk, len(chunks), file_outline)
+                chunk_key = review_key(chunk.text, service_choice, PROMPT_VERSION + ":chunk")
+                async for delta in cached_stream(service_choice, system, prompt, chunk_key):
+                    queue.put_nowait(delta)
+        except Exception as e:
+            queue.put_nowait(e if isinstance(e, ProviderError) else ProviderError(service_choice, str(e)))
+        finally:
+            queue.put_nowait(done)
+
+    tasks = [asyncio.create_task(review_chunk(chunk, queue)) for chunk, queue in zip(chunks, queues)]
+    full_response = f"This file is long, so it was reviewed in {len(chunks)} parts.\n"
+    yield full_response
+    failures = []
     try:
+        for chunk, queue in zip(chunks, queues):
+            header = f"\n\n### Lines {chunk.start_line}-{chunk.end_line}\n\n"
+            full_response += header
+            yield header
+            while (item := await queue.get()) is not done:
+                if isinstance(item, ProviderError):
+                    failures.append(item)
+                    item = f"\n_This part could not be reviewed: {item}_\n"
+                full_response += item
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+    if len(failures) == len(chunks):
+        raise failures[-1]
+    if not failures:
+        await review_cache.set(key, full_response)
 
-        user_content = f"User question: {code}"
-            
-        response = client.chat.completions.create(
-            model="anthropic/claude-3-opus:free",  # Using Claude 3 Opus via OpenRouter for QwQ
-            messages = [
-                {"role": "system", "content": SYSTEM_INSTRUCTION},
-                {"role": "user", "content": user_content}
-            ],
-            stream=True  # Enable streaming for word-by-word response
-        )
-        
-        # For streaming response
-        full_response = ""
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                full_response += chunk.choices[0].delta.content
-        
-        return full_response
-    except Exception as e:
-        print(f"Error in generating the review in QwQ: {e}")
-        return "Failed to generate review in QwQ."
+
+async def stream_review(code: str, service_choice: str) -> AsyncIterator[str]:
+    """
+    Streams the chosen provider's review of the code as text deltas.
+
+    A cached review is yielded as a single delta. Code over
+    REVIEW_CHUNK_TOKENS goes through the chunked map-reduce pipeline.
+    """
+    validate_service(service_choice)
+    validate_size(code)
+    if estimate_tokens(code) > REVIEW_CHUNK_TOKENS:
+        source = stream_chunked_review(code, service_choice)
+    else:
+        source = cached_stream(service_choice, SYSTEM_INSTRUCTION, build_user_prompt(code))
+    async for delta in source:
+        yield delta
+
+
+async def generate_review(code: str, service_choice: str) -> str:
+    """
+    Calls the chosen provider to analyze and review code.
+
+    Raises ValueError for an unknown service and ProviderError when the
+    provider (or, for 'auto', every candidate) fails.
+    """
+    full_response = ""
+    async for delta in stream_review(code, service_choice):
+        full_response += delta
+    return full_response
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from services.file_store import content_hash
+
+logger = logging.getLogger(__name__)
+
+# 0 disables buffering: every save is written through immediately.
+AUTOSAVE_DEBOUNCE = float(os.getenv("AUTOSAVE_DEBOUNCE_MS", "2000")) / 1000
+# A file that keeps changing is still flushed at least this often.
+AUTOSAVE_MAX_DELAY = float(os.getenv("AUTOSAVE_MAX_DELAY_MS", "10000")) / 1000
+RETRY_DELAY = 2.0
+
+FileKey = Tuple[str, str, str]  # (uid, folder, filename)
+FlushFn = Callable[[str, str, str, str], Awaitable[bool]]
+
+
+class PendingWrite:
+    """Latest unflushed content for one file."""
+
+    def __init__(self, content: str):
+        self.content = content
+        self.hash = content_hash(content)
+        self.first_saved = time.monotonic()
+        self.saves = 1
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class AutosaveBuffer:
+    """
+    Write-behind buffer for editor autosaves.
+
+    Saves for the same (uid, folder, filename) replace each other in
+    memory and are written once the file has been quiet for the debounce
+    window, or once AUTOSAVE_MAX_DELAY has passed since the first
+    unflushed save. Reads of a dirty file are answered from the buffer.
+    A failed flush keeps the content and retries; `aclose` flushes
+    everything on shutdown so the last edit is never dropped.
+
+    The buffer is per worker: another worker serving the same user sees
+    the last flushed version until the debounce window elapses.
+    """
+
+    def __init__(self, flush_fn: FlushFn, debounce: float = AUTOSAVE_DEBOUNCE,
+                 max_delay: float = AUTOSAVE_MAX_DELAY):
+        self.flush_fn = flush_fn
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._pending: Dict[FileKey, PendingWrite] = {}
+        self._flushing: Dict[FileKey, asyncio.Task] = {}
+        self._closed = False
+        self.stats = {
+            "saves": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "flush_errors": 0,
+            "flush_ms_total": 0.0,
+            "flush_ms_last": None,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.debounce > 0 and not self._closed
+
+    def get(self, key: FileKey) -> Optional[PendingWrite]:
+        return self._pending.get(key)
+
+    def save(self, key: FileKey, content: str) -> PendingWrite:
+        """Buffers the latest content for a file and (re)arms its flush timer."""
+        self.stats["saves"] += 1
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = PendingWrite(content)
+            self._pending[key] = pending
+        else:
+            self.stats["coalesced"] += 1
+            pending.content = content
+            pending.hash = content_hash(content)
+            pending.saves += 1
+        self._schedule(key, pending)
+        return pending
+
+    def _schedule(self, key: FileKey, pending: PendingWrite, delay: Optional[float] = None):
+        if pending.timer is not None:
+            pending.timer.cancel()
+        if delay is None:
+            overdue = pending.first_saved + self.max_delay - time.monotonic()
+            delay = max(0.0, min(self.debounce, overdue))
+        loop = asyncio.get_running_loop()
+        pending.timer = loop.call_later(delay, self._start_flush, key)
+
+    def _start_flush(self, key: FileKey) -> asyncio.Task:
+        """Starts a registered flush of `key`, or returns the one already running."""
+        running = self._flushing.get(key)
+        if running is not None:
+            # A flush is already running; the newer content goes out after it.
+            pending = self._pending.get(key)
+            if pending is not None:
+                self._schedule(key, pending, self.debounce)
+            return running
+        task = asyncio.create_task(self._flush(key))
+        self._flushing[key] = task
+        return task
+
+    async def _flush(self, key: FileKey):
+        try:
+            await self._write(key)
+        finally:
+            # A later flush of the same file may have registered itself meanwhile.
+            if self._flushing.get(key) is asyncio.current_task():
+                del self._flushing[key]
+
+    async def _write(self, key: FileKey):
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+            pending.timer = None
+        uid, folder, filename = key
+        content, digest = pending.content, pending.hash
+        started = time.perf_counter()
+        try:
+            await self.flush_fn(uid, folder, filename, content)
+        except Exception as e:
+            self.stats["flush_errors"] += 1
+            logger.error(f"Autosave flush failed for {folder}/{filename}: {e}")
+            if not self._closed:
+                self._schedule(key, pending, RETRY_DELAY)
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["flushes"] += 1
+        self.stats["flush_ms_total"] += elapsed_ms
+        self.stats["flush_ms_last"] = round(elapsed_ms, 1)
+        # Only forget the entry if no newer save arrived while flushing.
+        if self._pending.get(key) is pending and pending.hash == digest:
+            del self._pending[key]
+
+    async def flush_now(self, key: FileKey):
+        """Writes a dirty file through now (used before deletes and conditional saves)."""
+        await self.wait_flushing(key)
+        if key in self._pending:
+            await asyncio.gather(self._start_flush(key), return_exceptions=True)
+
+    async def flush_folder(self, uid: str, folder: str):
+        """Writes through every dirty file in a folder (used before exports and imports)."""
+        keys = [k for k in self._pending if k[0] == uid and k[1] == folder]
+        await asyncio.gather(*(self.flush_now(key) for key in keys))
+        await self.wait_flushing_folder(uid, folder)
+
+    async def wait_flushing(self, key: FileKey):
+        """Waits for an in-flight flush of `key`, so a delete cannot be overtaken by it."""
+        running = self._flushing.get(key)
+        if running is not None:
+            await asyncio.gather(running, return_exceptions=True)
+
+    async def wait_flushing_folder(self, uid: str, folder: str):
+        """Waits for every in-flight flush in a folder, so a folder delete cannot be overtaken by one."""
+        running = [task for k, task in self._flushing.items() if k[0] == uid and k[1] == folder]
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    def discard(self, key: FileKey):
+        pending = self._pending.pop(key, None)
+        if pending is not None and pending.timer is not None:
+            pending.timer.cancel()
+
+    def discard_folder(self, uid: str, folder: str):
+        for key in [k for k in self._pending if k[0] == uid and k[1] == folder]:
+            self.discard(key)
+
+    async def aclose(self):
+        """Flushes every pending write. Called from the app lifespan on shutdown."""
+        self._closed = True
+        if self._flushing:
+            await asyncio.gather(*self._flushing.values(), return_exceptions=True)
+        keys = list(self._pending)
+        await asyncio.gather(*(self._start_flush(key) for key in keys), return_exceptions=True)
+        if self._pending:
+            logger.error(f"Autosave shutdown left {len(self._pending)} unflushed file(s)")
+
+    def snapshot(self) -> dict:
+        flushes = self.stats["flushes"]
+        return {
+            **self.stats,
+            "queue_depth": len(self._pending),
+            "flushing": len(self._flushing),
+            "flush_ms_avg": round(self.stats["flush_ms_total"] / flushes, 1) if flushes else None,
+            "debounce_ms": int(self.debounce * 1000),
+        }
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from services.ai_service import SYSTEM_INSTRUCTION, provider_stream, validate_service
+from services.cache import TTLCache, get_redis
+from services.review_cache import normalize_code
+from services.review_chunking import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CHAT_SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "1800"))
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "5000"))
+CHAT_SESSION_REDIS = os.getenv("CHAT_SESSION_REDIS", "0") == "1"
+# Prompt budget for history (summary + recent turns), excluding the new message.
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "4000"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "600"))
+CHAT_MESSAGE_MAX_TOKENS = int(os.getenv("CHAT_MESSAGE_MAX_TOKENS", "20000"))
+SWEEP_INTERVAL = 60
+REDIS_KEY_PREFIX = "xenai:chat:"
+
+SUMMARY_INSTRUCTION = """
+You maintain a running summary of a programming help conversation.
+Merge the new messages into the existing summary. Keep the languages, file and function names, errors, decisions and any open questions; drop greetings and code that was superseded.
+Answer with the updated summary only, in at most {words} words.
+"""
+
+SessionKey = Tuple[str, str]  # (uid, session_id)
+
+
+class ChatSession:
+    """
+    Compact chat state: a rolling summary of older turns plus the most
+    recent messages verbatim, stored as [role, text, tokens] with role
+    "u" or "a".
+    """
+
+    def __init__(self, session_id: str, service_choice: str, summary: str = "",
+                 messages: Optional[List[list]] = None, turns: int = 0):
+        self.session_id = session_id
+        self.service_choice = service_choice
+        self.summary = summary
+        self.messages: List[list] = messages or []
+        self.turns = turns
+
+    def add(self, role: str, text: str):
+        text = normalize_code(text)
+        self.messages.append([role, text, estimate_tokens(text)])
+
+    def window(self, budget: int = CHAT_CONTEXT_TOKENS) -> int:
+        """Index of the oldest message that still fits, newest first, beside the summary."""
+        remaining = budget - estimate_tokens(self.summary)
+        start = len(self.messages)
+        while start > 0 and self.messages[start - 1][2] <= remaining:
+            remaining -= self.messages[start - 1][2]
+            start -= 1
+        return start
+
+    def build_prompt(self, message: str) -> str:
+        start = self.window()
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of the earlier conversation:\n{self.summary}")
+        if start < len(self.messages):
+            recent = "\n\n".join(
+                f"{'User' if role == 'u' else 'Assistant'}: {text}" for role, text, _ in self.messages[start:]
+            )
+            parts.append(f"Recent messages:\n{recent}")
+        parts.append(f"User question: {message}")
+        return "\n\n".join(parts)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "session_id": self.session_id,
+            "service_choice": self.service_choice,
+            "summary": self.summary,
+            "messages": self.messages,
+            "turns": self.turns,
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: str) -> "ChatSession":
+        return cls(**json.loads(raw))
+
+
+class ChatSessionStore:
+    """
+    Chat sessions keyed by (uid, session_id) that expire after
+    CHAT_SESSION_TTL seconds without a turn.
+
+    Like the review cache, the local tier is a per-worker TTL/LRU and
+    CHAT_SESSION_REDIS=1 adds a shared Redis tier so any worker can serve
+    the next turn. Turns of one session are serialized per worker.
+    """
+
+    def __init__(self, maxsize: int = CHAT_SESSION_MAX, ttl: int = CHAT_SESSION_TTL):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.redis = None
+        # Per-session lock and the number of turns holding or waiting for it.
+        self._locks: Dict[SessionKey, list] = {}
+        self._summaries: Dict[SessionKey, asyncio.Task] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.stats = {
+            "turns": 0,
+            "sessions_created": 0,
+            "expired": 0,
+            "summaries": 0,
+            "summary_errors": 0,
+            "prompt_tokens_total": 0,
+            "redis_errors": 0,
+        }
+
+    async def start(self):
+        if CHAT_SESSION_REDIS and self.redis is None:
+            self.redis = get_redis()
+        self._sweeper = asyncio.create_task(self._sweep())
+
+    async def aclose(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for task in self._summaries.values():
+            task.cancel()
+        # The shared client itself is closed by cache.close_redis.
+        self.redis = None
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.stats["expired"] += self.local.purge_expired()
+
+    @asynccontextmanager
+    async def locked(self, key: SessionKey):
+        """
+        Serializes the turns of one session. The lock is dropped once no
+        turn holds or waits for it; `Lock.locked()` cannot tell, since it
+        is already False while a waiter is being woken.
+        """
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    async def get(self, key: SessionKey) -> Optional[ChatSession]:
+        session = self.local.get(key)
+        if session is not None or self.redis is None:
+            return session
+        try:
+            raw = await self.redis.get(REDIS_KEY_PREFIX + ":".join(key))
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Chat session Redis read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        session = ChatSession.from_json(raw)
+        self.local.set(key, session)
+        return session
+
+    async def save(self, key: SessionKey, session: ChatSession):
+        self.local.set(key, session)
+        if self.redis is not None:
+            try:
+                await self.redis.set(REDIS_KEY_PREFIX + ":".join(key), session.to_json(), ex=self.ttl)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning(f"Chat session Redis write failed: {e}")
+
+    async def delete(self, key: SessionKey) -> bool:
+        found = self.local.pop(key) is not None
+        task = self._summaries.pop(key, None)
+        if task is not None:
+            task.cancel()
+        if self.redis is not None:
+            try:
+                found = bool(await self.redis.delete(REDIS_KEY_PREFIX + ":".join(key))) or found
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning(f"Chat session Redis delete failed: {e}")
+        return found
+
+    def schedule_summary(self, key: SessionKey, session: ChatSession):
+        """Folds messages that no longer fit the window into the summary, off the request path."""
+        if session.window(CHAT_CONTEXT_TOKENS - CHAT_SUMMARY_TOKENS) == 0 or key in self._summaries:
+            return
+        task = asyncio.create_task(self._summarize(key, session))
+        self._summaries[key] = task
+        task.add_done_callback(lambda _: self._summaries.pop(key, None))
+
+    async def _summarize(self, key: SessionKey, session: ChatSession):
+        # Runs without the session lock so the next turn is never held up;
+        # only this task ever removes messages, and only from the front.
+        try:
+            # Leave room in the window for the summary itself.
+            cut = session.window(CHAT_CONTEXT_TOKENS - CHAT_SUMMARY_TOKENS)
+            if cut == 0:
+                return
+            older = "\n\n".join(
+                f"{'User' if role == 'u' else 'Assistant'}: {text}" for role, text, _ in session.messages[:cut]
+            )
+            system = SUMMARY_INSTRUCTION.format(words=int(CHAT_SUMMARY_TOKENS * 0.75))
+            prompt = f"Existing summary:\n{session.summary or '(none)'}\n\nNew messages:\n{older}"
+            summary = ""
+            async for delta in provider_stream(session.service_choice, system, prompt):
+                summary += delta
+            if not summary.strip():
+                return
+            session.summary = summary.strip()
+            del session.messages[:cut]
+            await self.save(key, session)
+            self.stats["summaries"] += 1
+        except Exception as e:
+            self.stats["summary_errors"] += 1
+            logger.warning(f"Summarizing chat session failed: {e}")
+
+    def snapshot(self) -> dict:
+        turns = self.stats["turns"]
+        return {
+            **self.stats,
+            "prompt_tokens_avg": round(self.stats["prompt_tokens_total"] / turns, 1) if turns else None,
+            "local_sessions": len(self.local),
+            "summaries_running": len(self._summaries),
+            "redis_enabled": self.redis is not None,
+        }
+
+
+chat_sessions = ChatSessionStore()
+
+
+def validate_message(message: str):
+    """Raise ValueError when a chat message is over the per-message budget."""
+    if estimate_tokens(message) > CHAT_MESSAGE_MAX_TOKENS:
+        raise ValueError(f"Message is too long (limit ~{CHAT_MESSAGE_MAX_TOKENS} tokens)")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+async def stream_chat(user_id: str, session_id: str, message: str, service_choice: str) -> AsyncIterator[str]:
+    """
+    One chat turn: the prompt is the session summary, the recent messages
+    that fit CHAT_CONTEXT_TOKENS and the new message, so the per-turn cost
+    stays flat however long the session runs. The turn is recorded only
+    if the provider answered.
+    """
+    validate_service(service_choice)
+    validate_message(message)
+    key = (user_id, session_id)
+    answer = ""
+    async with chat_sessions.locked(key):
+        session = await chat_sessions.get(key)
+        if session is None:
+            session = ChatSession(session_id, service_choice)
+            chat_sessions.stats["sessions_created"] += 1
+        session.service_choice = service_choice
+        prompt = session.build_prompt(message)
+        chat_sessions.stats["turns"] += 1
+        chat_sessions.stats["prompt_tokens_total"] += estimate_tokens(SYSTEM_INSTRUCTION + prompt)
+
+        async for delta in provider_stream(service_choice, SYSTEM_INSTRUCTION, prompt):
+            answer += delta
+            yield delta
+        if answer:
+            session.add("u", message)
+            session.add("a", answer)
+            session.turns += 1
+            await chat_sessions.save(key, session)
+    if answer:
+        chat_sessions.schedule_summary(key, session)
@@ -0,0 +1,77 @@
+import hashlib
+from typing import Optional
+
+from firebase_client import async_transactional, server_timestamp
+
+from services import project_index
+
+
+class PreconditionFailed(Exception):
+    """An If-Match precondition did not hold."""
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def etag_matches(header: Optional[str], digest: Optional[str]) -> bool:
+    """True when an If-Match / If-None-Match header names the given content hash."""
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    if "*" in candidates:
+        return True
+    return digest is not None and any(tag.removeprefix("W/").strip('"') == digest for tag in candidates)
+
+
+def file_ref(db, user_id: str, folder: str, filename: str):
+    return db.collection("users").document(user_id).collection(folder).document(filename)
+
+
+async def write_file(db, user_id: str, folder: str, filename: str, content: str,
+                     if_match: Optional[str] = None) -> bool:
+    """
+    Writes a file and its index entry in one transaction. Only that entry
+    of the index document is read and written.
+
+    Returns False without writing when the content hash is unchanged.
+    Raises PreconditionFailed when `if_match` does not name the stored hash
+    and project_index.IndexFull when a new file does not fit in the index.
+    """
+    doc_ref = file_ref(db, user_id, folder, filename)
+    size = len(content.encode("utf-8"))
+    digest = content_hash(content)
+
+    @async_transactional
+    async def write(transaction) -> bool:
+        index = await project_index.read_entry_in_transaction(db, user_id, folder, filename, transaction)
+        current = project_index.file_entry(index, folder, filename)
+        current_hash = current.get("hash") if current else None
+        if current and current_hash is None:
+            # Saved before hashes were recorded: hash the stored content, as read_file does for its ETag.
+            snapshot = await doc_ref.get(field_paths=["content"], transaction=transaction)
+            if snapshot.exists:
+                current_hash = content_hash((snapshot.to_dict() or {}).get("content", ""))
+        if if_match is not None and not (current and etag_matches(if_match, current_hash)):
+            raise PreconditionFailed("File was modified since it was read")
+        if current_hash == digest:
+            return False
+        project_index.put_entry_in_transaction(
+            db, user_id, transaction, index, folder, filename, project_index.file_meta(size, digest)
+        )
+        transaction.set(doc_ref, {
+            "content": content,
+            "filename": filename,
+            "folder": folder,
+            "size": size,
+            "content_hash": digest,
+            "last_modified": server_timestamp()
+        })
+        return True
+
+    try:
+        return await write(db.transaction())
+    except project_index.IndexMissing:
+        # Only the first save of a project that predates the index gets here.
+        await project_index.ensure_index(db, user_id)
+        return await write(db.transaction())
@@ -1,20 +1,243 @@
 
-from firebase_admin import auth
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from typing import Dict, Optional
+
+import httpx
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-    
+
+from firebase_client import FirebaseUnavailable, firebase_ready
+from services import metrics
+from services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Google's x509 certificates that sign Firebase ID tokens.
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+FIREBASE_ISSUER = "https://securetoken.google.com/{project_id}"
+CERTS_DEFAULT_MAX_AGE = 3600
+CERTS_MIN_REFRESH = 60
+CLOCK_SKEW_SECONDS = 10
+
+TOKEN_CACHE_SIZE = 10_000
 
 # Define Bearer token security scheme
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# Verified claims keyed by sha256(token); each entry expires at the token's `exp`.
+_token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=3600)
+
+auth_stats = {
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "failures": 0,
+    "verify_ms_total": 0.0,
+    "key_refreshes": 0,
+}
+
+
+class TokenRevoked(Exception):
+    """The Admin SDK reported the token as revoked."""
+
+
+class SigningKeys:
+    """
+    Background-refreshed copy of the Firebase token signing certificates.
+
+    The certificates are fetched in the background right after startup
+    (so startup does not wait on Google) and re-fetched shortly before
+    Google's Cache-Control max-age runs out, so verifying a token never
+    waits on the network.
+    """
+
+    def __init__(self):
+        self.certs: Dict[str, str] = {}
+        self.expires_at = 0.0
+        self.last_attempt = 0.0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def refresh(self, min_interval: float = 0.0) -> bool:
+        """
+        Re-fetches the certificates. With `min_interval`, does nothing and
+        returns False if the last attempt was more recent than that.
+        """
+        async with self._lock:
+            if min_interval and time.time() - self.last_attempt < min_interval:
+                return False
+            self.last_attempt = time.time()
+            client = self._client or httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+            try:
+                response = await client.get(FIREBASE_CERTS_URL)
+                response.raise_for_status()
+            finally:
+                if client is not self._client:
+                    await client.aclose()
+            match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+            max_age = int(match.group(1)) if match else CERTS_DEFAULT_MAX_AGE
+            self.certs = response.json()
+            self.expires_at = time.time() + max_age
+            auth_stats["key_refreshes"] += 1
+            return True
+
+    async def _refresh_loop(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning(f"Could not prefetch Firebase signing keys: {e}")
+        while True:
+            delay = max(CERTS_MIN_REFRESH, (self.expires_at - time.time()) * 0.9)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Refreshing Firebase signing keys failed: {e}")
+                await asyncio.sleep(CERTS_MIN_REFRESH)
+
+    @property
+    def fresh(self) -> bool:
+        return bool(self.certs) and time.time() < self.expires_at
+
+
+signing_keys = SigningKeys()
+
 
-def verify_firebase_token(auth_credentials: HTTPAuthorizationCredentials = Security(security)):
-    """Verify Firebase ID token and return user data."""
-    token = auth_credentials.credentials  
+def _project_id() -> Optional[str]:
+    if not firebase_ready():
+        return None
+    import firebase_admin
+
+    try:
+        return firebase_admin.get_app().project_id
+    except ValueError:
+        return None
+
+
+def _decode_with_keys(token: str, project_id: str) -> dict:
+    """
+    Same checks as auth.verify_id_token (signature, audience, issuer, exp,
+    subject) against the prefetched certificates.
+    """
+    from google.auth import jwt as google_jwt
+
+    claims = google_jwt.decode(
+        token, certs=signing_keys.certs, audience=project_id, clock_skew_in_seconds=CLOCK_SKEW_SECONDS
+    )
+    if claims.get("iss") != FIREBASE_ISSUER.format(project_id=project_id):
+        raise ValueError("Firebase ID token has incorrect issuer")
+    subject = claims.get("sub")
+    if not subject or len(subject) > 128:
+        raise ValueError("Firebase ID token has invalid subject")
+    claims["uid"] = subject
+    return claims
+
+
+async def _verify(token: str) -> dict:
+    project_id = _project_id()
+    if project_id and signing_keys.fresh:
+        try:
+            return _decode_with_keys(token, project_id)
+        except ValueError as e:
+            if "Certificate for key id" not in str(e):
+                raise
+            # Keys may have rotated since the last prefetch. Any token can name an
+            # unknown key id, so re-fetch at most once per CERTS_MIN_REFRESH.
+            if not await signing_keys.refresh(min_interval=CERTS_MIN_REFRESH):
+                raise
+            return _decode_with_keys(token, project_id)
+    if not firebase_ready():
+        raise FirebaseUnavailable("Firebase is not initialized")
+    # No prefetched keys (yet): let the Admin SDK fetch them, off the event loop.
+    from firebase_admin import auth
+
+    try:
+        return await asyncio.to_thread(auth.verify_id_token, token)
+    except auth.RevokedIdTokenError as e:
+        raise TokenRevoked(str(e)) from e
+
+
+def _observe_verify(result: str, started: float):
+    elapsed = time.perf_counter() - started
+    metrics.AUTH_VERIFY_SECONDS.labels(result).observe(elapsed)
+    metrics.add_timing("auth", elapsed)
+
+
+async def verify_firebase_token(auth_credentials: HTTPAuthorizationCredentials = Security(security)):
+    """
+    Verify Firebase ID token and return user data.
+
+    Verified tokens are cached until their `exp`, so a session that sends
+    the same token for an hour pays for signature verification once.
+    """
+    token = auth_credentials.credentials
     if not token:
         raise HTTPException(status_code=401,detail="Misssing token")
+
+    started = time.perf_counter()
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    cached = _token_cache.get(key)
+    if cached is not None:
+        auth_stats["cache_hits"] += 1
+        _observe_verify("cache_hit", started)
+        return cached
+    auth_stats["cache_misses"] += 1
+
+    result = "failed"
     try:
-        decoded_token = auth.verify_id_token(token)  
-        return decoded_token  
+        decoded_token = await _verify(token)
+        result = "verified"
+    except FirebaseUnavailable:
+        result = "unavailable"
+        raise HTTPException(status_code=503, detail="Authentication is not available yet")
+    except TokenRevoked:
+        auth_stats["failures"] += 1
+        raise HTTPException(status_code=401, detail="Token has been revoked. Please log in again.")
     except Exception as e:
+        auth_stats["failures"] += 1
+        if "expired" in str(e).lower():
+            raise HTTPException(status_code=401, detail="Token expired. Please log in again.")
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
+    finally:
+        auth_stats["verify_ms_total"] += (time.perf_counter() - started) * 1000
+        _observe_verify(result, started)
+
+    ttl = decoded_token.get("exp", 0) - time.time()
+    if ttl > 0:
+        _token_cache.set(key, decoded_token, ttl=ttl)
+    return decoded_token
+
+
+async def optional_firebase_user(auth_credentials: HTTPAuthorizationCredentials = Security(optional_security)):
+    """Like verify_firebase_token, but returns None when no token is sent."""
+    if auth_credentials is None or not auth_credentials.credentials:
+        return None
+    return await verify_firebase_token(auth_credentials)
+
 
+def auth_status() -> dict:
+    misses = auth_stats["cache_misses"]
+    return {
+        **auth_stats,
+        "verify_ms_avg": round(auth_stats["verify_ms_total"] / misses, 3) if misses else None,
+        "cached_tokens": len(_token_cache),
+        "signing_keys": len(signing_keys.certs),
+        "signing_keys_fresh": signing_keys.fresh,
+    }
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Firestore's limit on writes in one batch.
+BATCH_LIMIT = 500
+# Commit requests are capped at 10 MiB; stay well below it.
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+DELETE_PARALLELISM = int(os.getenv("FIRESTORE_DELETE_PARALLELISM", "4"))
+
+ProgressCallback = Callable[[int], Awaitable[None]]
+
+
+async def delete_collection(db, collection_ref, on_progress: Optional[ProgressCallback] = None,
+                            page_size: int = BATCH_LIMIT, parallelism: int = DELETE_PARALLELISM) -> int:
+    """
+    Deletes every document in a collection, including nested subcollections,
+    and returns how many documents were removed.
+
+    A recursive query returns the collection's documents and those of
+    every nested subcollection, so nested data costs no extra listing
+    calls. Pages of `page_size` document references (no field data) are
+    read with cursors while earlier pages are still being committed; each
+    page becomes one write batch, and at most `parallelism` pages are read
+    ahead or in flight. `on_progress` is awaited with the running total
+    after every commit.
+    """
+    slots = asyncio.Semaphore(parallelism)
+    deleted = 0
+    commits = []
+
+    async def commit_page(docs):
+        nonlocal deleted
+        try:
+            batch = db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            await batch.commit()
+            deleted += len(docs)
+            if on_progress is not None:
+                await on_progress(deleted)
+        finally:
+            slots.release()
+
+    query = collection_ref.recursive().select([]).order_by("__name__").limit(page_size)
+    last = None
+    try:
+        while True:
+            await slots.acquire()
+            page_query = query.start_after(last) if last is not None else query
+            docs = [doc async for doc in page_query.stream()]
+            if not docs:
+                slots.release()
+                break
+            commits.append(asyncio.create_task(commit_page(docs)))
+            last = docs[-1]
+            if len(docs) < page_size:
+                break
+        await asyncio.gather(*commits)
+    except BaseException:
+        for task in commits:
+            task.cancel()
+        raise
+    return deleted
+
+
+async def set_documents(db, writes: Iterable[Tuple[object, dict, int]],
+                        parallelism: int = DELETE_PARALLELISM) -> int:
+    """
+    Writes (doc_ref, data, approx_bytes) triples with batched `set`s and
+    returns how many documents were written.
+
+    Batches are cut at BATCH_LIMIT writes or BATCH_MAX_BYTES, whichever
+    comes first, and up to `parallelism` of them are committed at once.
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+    batches: List[list] = []
+    current: list = []
+    current_bytes = 0
+    for doc_ref, data, size in writes:
+        if current and (len(current) >= BATCH_LIMIT or current_bytes + size > BATCH_MAX_BYTES):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append((doc_ref, data))
+        current_bytes += size
+    if current:
+        batches.append(current)
+
+    async def commit(page):
+        async with semaphore:
+            batch = db.batch()
+            for doc_ref, data in page:
+                batch.set(doc_ref, data)
+            await batch.commit()
+
+    await asyncio.gather(*(commit(page) for page in batches))
+    return sum(len(page) for page in batches)
+
@@ -0,0 +1,159 @@
+import difflib
+import hashlib
+import logging
+import os
+from typing import AsyncIterator, List, NamedTuple, Optional
+
+from firebase_client import server_timestamp
+from services.ai_service import (
+    INCREMENTAL_INSTRUCTION, PROMPT_VERSION, SYSTEM_INSTRUCTION,
+    cached_stream, stream_review, validate_service, validate_size,
+)
+from services.file_store import content_hash
+from services.review_chunking import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# review_state/{uid}/files/{hash(folder, filename)}: last reviewed version and its review.
+REVIEW_STATE_COLLECTION = "review_state"
+INCREMENTAL_CONTEXT_LINES = int(os.getenv("INCREMENTAL_CONTEXT_LINES", "3"))
+# Above this share of changed lines a fresh full review is cheaper to read and as cheap to produce.
+INCREMENTAL_MAX_CHANGE_RATIO = float(os.getenv("INCREMENTAL_MAX_CHANGE_RATIO", "0.3"))
+# After this many stacked updates the next request re-baselines with a full review.
+INCREMENTAL_MAX_UPDATES = int(os.getenv("INCREMENTAL_MAX_UPDATES", "5"))
+# Leave room under Firestore's 1 MiB document limit.
+STATE_MAX_BYTES = 900 * 1024
+
+incremental_stats = {
+    "full": 0,
+    "incremental": 0,
+    "unchanged": 0,
+    "prompt_tokens_sent": 0,
+    "prompt_tokens_saved": 0,
+}
+
+
+class ChangeSet(NamedTuple):
+    diff: str
+    changed_lines: int
+    start_line: int  # first changed line in the new version, 1-based
+    end_line: int
+
+
+def state_ref(db, user_id: str, folder: str, filename: str):
+    doc_id = hashlib.sha256(f"{folder}\0{filename}".encode("utf-8")).hexdigest()[:40]
+    return db.collection(REVIEW_STATE_COLLECTION).document(user_id).collection("files").document(doc_id)
+
+
+def diff_versions(old: str, new: str, context: int = INCREMENTAL_CONTEXT_LINES) -> Optional[ChangeSet]:
+    """Unified diff of two versions with `context` lines around each hunk, or None if identical."""
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    changes = [op for op in matcher.get_opcodes() if op[0] != "equal"]
+    if not changes:
+        return None
+    changed = sum(max(i2 - i1, j2 - j1) for _, i1, i2, j1, j2 in changes)
+    diff = "\n".join(difflib.unified_diff(old_lines, new_lines, "before", "after", n=context, lineterm=""))
+    return ChangeSet(diff, changed, changes[0][3] + 1, max(changes[-1][4], changes[-1][3] + 1))
+
+
+def render(state: dict) -> str:
+    """The base review followed by every incremental update, oldest first."""
+    return state["base_review"] + "".join(
+        f"\n\n### Update after your changes to lines {u['start_line']}-{u['end_line']}\n\n{u['review']}"
+        for u in state.get("updates", [])
+    )
+
+
+def build_diff_prompt(filename: str, changes: ChangeSet) -> str:
+    return f"Changes to {filename}:\n{changes.diff}"
+
+
+async def _save_state(ref, state: dict):
+    size = len(state["content"].encode("utf-8")) + len(render(state).encode("utf-8"))
+    try:
+        if size > STATE_MAX_BYTES:
+            # Too big to keep; the next review of this file is a full one.
+            await ref.delete()
+        else:
+            await ref.set({**state, "updated": server_timestamp()})
+    except Exception as e:
+        logger.warning(f"Could not store review state: {e}")
+
+
+async def stream_file_review(db, user_id: str, folder: str, filename: str,
+                             code: str, service_choice: str) -> AsyncIterator[str]:
+    """
+    Streams the review of a saved file, reusing the previous one.
+
+    The first review of a file (or one after the prompt, the service or
+    most of the file changed) is a full review. After that only the
+    changed hunks, with INCREMENTAL_CONTEXT_LINES of context, are sent to
+    the provider, and its answer is appended to the previous review as an
+    update section. The stream starts with the previous review, so the
+    client always receives the complete, merged text.
+    """
+    validate_service(service_choice)
+    validate_size(code)
+    ref = state_ref(db, user_id, folder, filename)
+    snapshot = await ref.get()
+    state = snapshot.to_dict() if snapshot.exists else None
+    if state and (state.get("prompt_version") != PROMPT_VERSION or state.get("service_choice") != service_choice):
+        state = None
+
+    digest = content_hash(code)
+    if state and state["content_hash"] == digest:
+        incremental_stats["unchanged"] += 1
+        yield render(state)
+        return
+
+    changes = diff_versions(state["content"], code) if state else None
+    line_count = max(len(code.splitlines()), 1)
+    incremental = (
+        changes is not None
+        and changes.changed_lines / line_count <= INCREMENTAL_MAX_CHANGE_RATIO
+        and len(state.get("updates", [])) < INCREMENTAL_MAX_UPDATES
+    )
+
+    if not incremental:
+        incremental_stats["full"] += 1
+        incremental_stats["prompt_tokens_sent"] += estimate_tokens(code)
+        review = ""
+        async for delta in stream_review(code, service_choice):
+            review += delta
+            yield delta
+        updates: List[dict] = []
+        base_review = review
+    else:
+        incremental_stats["incremental"] += 1
+        prompt = build_diff_prompt(filename, changes)
+        sent = estimate_tokens(prompt)
+        incremental_stats["prompt_tokens_sent"] += sent
+        incremental_stats["prompt_tokens_saved"] += max(0, estimate_tokens(code) - sent)
+        yield render(state)
+        yield f"\n\n### Update after your changes to lines {changes.start_line}-{changes.end_line}\n\n"
+        review = ""
+        async for delta in cached_stream(service_choice, SYSTEM_INSTRUCTION + INCREMENTAL_INSTRUCTION, prompt):
+            review += delta
+            yield delta
+        updates = state.get("updates", []) + [
+            {"start_line": changes.start_line, "end_line": changes.end_line, "review": review}
+        ]
+        base_review = state["base_review"]
+
+    if review:
+        await _save_state(ref, {
+            "folder": folder,
+            "filename": filename,
+            "content": code,
+            "content_hash": digest,
+            "service_choice": service_choice,
+            "prompt_version": PROMPT_VERSION,
+            "base_review": base_review,
+            "updates": updates,
+        })
+
+
+def incremental_status() -> dict:
+    return dict(incremental_stats)
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional
+
+import httpx
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between /workers probes; 0 turns the probes (and queue depth reporting) off.
+HEALTH_INTERVAL = float(os.getenv("JUDGE0_HEALTH_INTERVAL", "10"))
+BREAKER_THRESHOLD = int(os.getenv("JUDGE0_BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.getenv("JUDGE0_BREAKER_COOLDOWN", "30"))
+EWMA_ALPHA = 0.2
+
+
+def configured_urls() -> List[str]:
+    """JUDGE0_URLS (comma separated) wins over the single JUDGE0_URL."""
+    urls = os.getenv("JUDGE0_URLS")
+    if urls:
+        return [url.strip().rstrip("/") for url in urls.split(",") if url.strip()]
+    return [os.getenv("JUDGE0_URL", "http://judge0:2358").rstrip("/")]
+
+
+class NoHealthyNode(Exception):
+    """Every Judge0 node has its circuit breaker open."""
+
+
+class Judge0Node:
+    """
+    One Judge0 instance with its own connection pool and circuit breaker.
+
+    The breaker opens after BREAKER_THRESHOLD consecutive failures and
+    stays open for BREAKER_COOLDOWN seconds; after that the node is
+    half-open and the next success (request or health probe) closes it.
+    """
+
+    def __init__(self, node_id: str, url: str):
+        self.id = node_id
+        self.url = url
+        self.client: Optional[httpx.AsyncClient] = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.ewma_latency_ms: Optional[float] = None
+        self.queue_depth: Optional[int] = None
+        self.last_probe: Optional[float] = None
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.url,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=30),
+                timeout=httpx.Timeout(15.0, connect=5.0),
+            )
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    @property
+    def state(self) -> str:
+        if not self.available:
+            return "open"
+        return "half-open" if self.consecutive_failures >= BREAKER_THRESHOLD else "closed"
+
+    def record_success(self, latency_ms: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.ewma_latency_ms = latency_ms if self.ewma_latency_ms is None else (
+            EWMA_ALPHA * latency_ms + (1 - EWMA_ALPHA) * self.ewma_latency_ms
+        )
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= BREAKER_THRESHOLD:
+            if self.available:
+                logger.warning(f"Judge0 node {self.url} ejected after {self.consecutive_failures} failures")
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Sends one request, tracking outstanding count, latency and failures."""
+        if self.client is None:
+            await self.start()
+        self.outstanding += 1
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.record_failure()
+            raise
+        finally:
+            self.outstanding -= 1
+        if response.status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success((time.perf_counter() - started) * 1000)
+        return response
+
+    async def probe(self):
+        """Health probe: GET /workers, which also reports the queue depth."""
+        self.last_probe = time.time()
+        try:
+            response = await self.request("GET", "/workers")
+        except httpx.HTTPError:
+            return
+        if response.status_code == 200:
+            try:
+                self.queue_depth = sum(worker.get("size", 0) for worker in response.json())
+            except (ValueError, TypeError, AttributeError):
+                self.queue_depth = None
+            if self.queue_depth is not None:
+                metrics.JUDGE0_QUEUE_DEPTH.labels(self.id).set(self.queue_depth)
+
+    def snapshot(self) -> dict:
+        return {
+            "id": self.id,
+            "url": self.url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "queue_depth": self.queue_depth,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ewma_latency_ms": None if self.ewma_latency_ms is None else round(self.ewma_latency_ms, 1),
+        }
+
+
+class Judge0Pool:
+    """Least-outstanding-requests balancer over the configured Judge0 nodes."""
+
+    def __init__(self, urls: List[str]):
+        self.nodes = [Judge0Node(str(index), url) for index, url in enumerate(urls)]
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await asyncio.gather(*(node.start() for node in self.nodes))
+        # Probed even with one node: the queue depth goes to /judge0/nodes and /metrics.
+        if self._health_task is None and HEALTH_INTERVAL > 0:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        await asyncio.gather(*(node.aclose() for node in self.nodes), return_exceptions=True)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(node.probe() for node in self.nodes))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    def node(self, node_id: str) -> Judge0Node:
+        for node in self.nodes:
+            if node.id == node_id:
+                return node
+        raise KeyError(node_id)
+
+    def pick(self, exclude: Optional[set] = None) -> Judge0Node:
+        """Available node with the fewest outstanding requests (then lowest latency)."""
+        exclude = exclude or set()
+        candidates = [n for n in self.nodes if n.available and n.id not in exclude]
+        if not candidates:
+            # A single node is never ejected for good: better to try than refuse.
+            if len(self.nodes) == 1 and not exclude:
+                return self.nodes[0]
+            raise NoHealthyNode("No healthy Judge0 node is available")
+        return min(candidates, key=lambda n: (n.outstanding, n.ewma_latency_ms or 0.0))
+
+    async def enqueue(self, path: str, **kwargs) -> "tuple[Judge0Node, httpx.Response]":
+        """
+        POSTs a new submission to the least loaded node.
+
+        Retries on another node only when the request provably did not
+        enqueue anything: it never connected, or the node answered 503.
+        A 500/502/504 may come from a proxy after Judge0 stored the
+        submission, so it is returned to the caller rather than retried,
+        and a program is never run twice because of a retry.
+        """
+        tried = set()
+        last_error: Optional[Exception] = None
+        for _ in range(len(self.nodes)):
+            try:
+                node = self.pick(tried)
+            except NoHealthyNode:
+                break
+            tried.add(node.id)
+            try:
+                response = await node.request("POST", path, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                last_error = e
+                continue
+            if response.status_code == 503:
+                last_error = httpx.HTTPStatusError(
+                    f"Judge0 node {node.url} returned {response.status_code}",
+                    request=response.request, response=response,
+                )
+                continue
+            return node, response
+        if last_error is not None:
+            raise last_error
+        raise NoHealthyNode("No healthy Judge0 node is available")
+
+    def snapshot(self) -> dict:
+        return {"nodes": [node.snapshot() for node in self.nodes]}
+
+
+pool = Judge0Pool(configured_urls())
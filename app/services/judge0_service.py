@@ -1,23 +1,414 @@
-import requests
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-JUDGE0_URL = "http://judge0:2358"
+import httpx
 
+from services import metrics
+from services.cache import TTLCache
+from services.judge0_pool import NoHealthyNode, pool
 
-def submit_code(source_code: str, language_id: int, stdin: str = ""):
-    """
-    Sends the source code to Judge0 for execution and returns the result.
-    """
+# Public URL Judge0 should PUT finished submissions to, e.g.
+# http://backend:8000/api/submissions/callback. Polling is used when unset.
+JUDGE0_CALLBACK_URL = os.getenv("JUDGE0_CALLBACK_URL")
+
+CPU_TIME_LIMIT = 2
+MEMORY_LIMIT = 128000
+RESULT_TIMEOUT = float(os.getenv("JUDGE0_RESULT_TIMEOUT", "30"))
+POLL_INITIAL_DELAY = 0.1
+POLL_MAX_DELAY = 1.0
+
+RESULT_FIELDS = "token,stdout,stderr,compile_output,message,status,time,wall_time,memory"
+
+# Judge0's default MAX_SUBMISSION_BATCH_SIZE.
+BATCH_SIZE = int(os.getenv("JUDGE0_BATCH_SIZE", "20"))
+
+# Judge0 status ids 1 (In Queue) and 2 (Processing) are the only unfinished ones.
+PENDING_STATUSES = {1, 2}
+
+_waiters: Dict[str, asyncio.Future] = {}
+
+# Opt-in cache of finished executions for deterministic programs.
+RESULT_CACHE_ENABLED = os.getenv("JUDGE0_RESULT_CACHE", "0") == "1"
+RESULT_CACHE_SIZE = int(os.getenv("JUDGE0_RESULT_CACHE_SIZE", "2048"))
+RESULT_CACHE_TTL = int(os.getenv("JUDGE0_RESULT_CACHE_TTL", "900"))
+# Accepted, Wrong Answer, Compilation Error and the Runtime Error family.
+# Time Limit Exceeded and Internal/Exec Format errors depend on load, so they are not cached.
+CACHEABLE_STATUSES = {3, 4, 6, 7, 8, 9, 10, 11, 12}
+
+_result_cache = TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+result_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+# Submissions whose caller went away: token -> job id, deleted once Judge0 reports them finished.
+_abandoned = TTLCache(10_000, RESULT_TIMEOUT * 10)
+_background: set = set()
+cancel_stats = {"abandoned": 0, "deleted": 0, "delete_deferred": 0, "delete_failed": 0}
+
+
+class Judge0Error(Exception):
+    """Judge0 rejected or failed a request."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+async def start():
+    """Open the node connection pools and health probes. Called from the app lifespan."""
+    await pool.start()
+
+
+async def aclose():
+    await pool.aclose()
+
+
+def make_job_id(node_id: str, token: str) -> str:
+    """Job ids carry the node that owns the Judge0 token: "<node>.<token>"."""
+    return f"{node_id}.{token}"
+
+
+def split_job_id(job_id: str) -> Tuple[str, str]:
+    node_id, _, token = job_id.rpartition(".")
+    return node_id or "0", token
+
+
+def _node_for(job_id: str):
+    node_id, token = split_job_id(job_id)
+    try:
+        return pool.node(node_id), token
+    except KeyError:
+        raise Judge0Error("Submission not found", 404)
+
+
+def build_payload(source_code: str, language_id: int, stdin: str = "",
+                  expected_output: Optional[str] = None) -> dict:
     payload = {
         "language_id": language_id,
         "source_code": source_code,
         "stdin": stdin,
-        "cpu_time_limit": 2,
-        "memory_limit": 128000,
+        "cpu_time_limit": CPU_TIME_LIMIT,
+        "memory_limit": MEMORY_LIMIT,
     }
+    if expected_output is not None:
+        payload["expected_output"] = expected_output
+    if JUDGE0_CALLBACK_URL:
+        payload["callback_url"] = JUDGE0_CALLBACK_URL
+    return payload
 
-    response = requests.post(f"{JUDGE0_URL}/submissions/?base64_encoded=false&wait=true", json=payload)
 
+def is_finished(result: dict) -> bool:
+    status = result.get("status") or {}
+    return status.get("id") not in PENDING_STATUSES
+
+
+async def create_submission(source_code: str, language_id: int, stdin: str = "",
+                            payload: Optional[dict] = None) -> str:
+    """
+    Enqueues the source code on the least loaded Judge0 node without
+    waiting and returns its job id.
+    """
+    try:
+        node, response = await pool.enqueue(
+            "/submissions/",
+            params={"base64_encoded": "false", "wait": "false"},
+            json=payload or build_payload(source_code, language_id, stdin),
+        )
+    except NoHealthyNode as e:
+        raise Judge0Error(str(e), 503)
     if response.status_code != 201:
-        return {"error": "Failed to submit code", "status_code": response.status_code}
+        raise Judge0Error("Failed to submit code", response.status_code)
+    return make_job_id(node.id, response.json()["token"])
+
 
+async def get_submission(job_id: str) -> dict:
+    """Fetches the current state of a submission."""
+    node, token = _node_for(job_id)
+    response = await node.request(
+        "GET",
+        f"/submissions/{token}",
+        params={"base64_encoded": "false", "fields": RESULT_FIELDS},
+    )
+    if response.status_code == 404:
+        raise Judge0Error("Submission not found", 404)
+    if response.status_code != 200:
+        raise Judge0Error("Failed to fetch submission", response.status_code)
     return response.json()
+
+
+async def delete_submission(job_id: str) -> bool:
+    """
+    Deletes a submission. Judge0 refuses while it is still queued or
+    running, and unless the node allows deletes (ALLOW_DELETE / auth).
+    """
+    node, token = _node_for(job_id)
+    response = await node.request("DELETE", f"/submissions/{token}", params={"fields": "token"})
+    return response.status_code == 200
+
+
+async def abandon(job_id: str):
+    """
+    Called when nobody is waiting for a submission anymore.
+
+    Tries to delete it right away; if Judge0 refuses because it is still
+    pending, the token is remembered and deleted when its callback arrives.
+    """
+    cancel_stats["abandoned"] += 1
+    try:
+        deleted = await delete_submission(job_id)
+    except (Judge0Error, httpx.HTTPError):
+        deleted = False
+    if deleted:
+        cancel_stats["deleted"] += 1
+    elif JUDGE0_CALLBACK_URL:
+        _abandoned.set(split_job_id(job_id)[1], job_id)
+        cancel_stats["delete_deferred"] += 1
+    else:
+        cancel_stats["delete_failed"] += 1
+
+
+async def _delete_finished(job_id: str):
+    try:
+        deleted = await delete_submission(job_id)
+    except (Judge0Error, httpx.HTTPError):
+        deleted = False
+    cancel_stats["deleted" if deleted else "delete_failed"] += 1
+
+
+def _in_background(coro):
+    # Runs cleanup outside the (cancelled) request task and keeps a reference until it is done.
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def abandon_later(job_ids):
+    for job_id in job_ids:
+        _in_background(abandon(job_id))
+
+
+def notify_finished(token: str):
+    """
+    Wakes anyone waiting on a submission after Judge0's callback.
+
+    The callback body is only used as a signal: its encoding depends on
+    Judge0's configuration, so the result is re-read with GET.
+    """
+    job_id = _abandoned.pop(token)
+    if job_id is not None:
+        _in_background(_delete_finished(job_id))
+        return
+    waiter = _waiters.get(token)
+    if waiter is not None and not waiter.done():
+        waiter.set_result(None)
+
+
+async def wait_for_result(job_id: str, timeout: float = RESULT_TIMEOUT) -> dict:
+    """
+    Waits until a submission finishes.
+
+    Polls with exponential backoff, and a callback that reaches this
+    worker ends the wait early. The backoff stays fast with callbacks
+    configured: with several workers most callbacks land on a worker that
+    has no waiter, so the poll is what notices the result.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = POLL_INITIAL_DELAY
+    _, token = split_job_id(job_id)
+    while True:
+        result = await get_submission(job_id)
+        if is_finished(result):
+            return result
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise Judge0Error("Timed out waiting for execution result", 504)
+        waiter = _waiters.setdefault(token, loop.create_future())
+        try:
+            await asyncio.wait_for(waiter, timeout=min(delay, remaining))
+        except asyncio.TimeoutError:
+            delay = min(delay * 2, POLL_MAX_DELAY)
+        finally:
+            if _waiters.get(token) is waiter:
+                del _waiters[token]
+
+
+def result_key(payload: dict) -> str:
+    """Content hash of everything that determines an execution's outcome."""
+    fields = {
+        key: payload.get(key)
+        for key in ("source_code", "language_id", "stdin", "expected_output", "cpu_time_limit", "memory_limit")
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cached_result(payload: dict, use_cache: bool = True) -> Optional[dict]:
+    if not RESULT_CACHE_ENABLED:
+        return None
+    if not use_cache:
+        result_cache_stats["bypassed"] += 1
+        return None
+    result = _result_cache.get(result_key(payload))
+    result_cache_stats["hits" if result is not None else "misses"] += 1
+    return result
+
+
+def store_result(payload: dict, result: dict, use_cache: bool = True):
+    if not (RESULT_CACHE_ENABLED and use_cache):
+        return
+    status = result.get("status") or {}
+    if status.get("id") in CACHEABLE_STATUSES:
+        _result_cache.set(result_key(payload), result)
+        result_cache_stats["stores"] += 1
+
+
+def result_cache_status() -> dict:
+    return {**result_cache_stats, "enabled": RESULT_CACHE_ENABLED, "entries": len(_result_cache)}
+
+
+async def create_batch(payloads: List[dict]) -> List[str]:
+    """
+    Enqueues many submissions through /submissions/batch and returns their
+    job ids in the same order. Large requests are split into BATCH_SIZE
+    chunks, each placed on the least loaded node.
+    """
+
+    async def post_chunk(chunk: List[dict]) -> List[str]:
+        try:
+            node, response = await pool.enqueue(
+                "/submissions/batch",
+                params={"base64_encoded": "false"},
+                json={"submissions": chunk},
+            )
+        except NoHealthyNode as e:
+            raise Judge0Error(str(e), 503)
+        if response.status_code != 201:
+            raise Judge0Error("Failed to submit batch", response.status_code)
+        items = response.json()
+        if any("token" not in item for item in items):
+            raise Judge0Error(f"Judge0 rejected a test case: {items}", 422)
+        return [make_job_id(node.id, item["token"]) for item in items]
+
+    chunks = [payloads[i:i + BATCH_SIZE] for i in range(0, len(payloads), BATCH_SIZE)]
+    tokens: List[str] = []
+    for chunk_tokens in await asyncio.gather(*(post_chunk(chunk) for chunk in chunks)):
+        tokens.extend(chunk_tokens)
+    return tokens
+
+
+async def get_batch(job_ids: List[str]) -> List[dict]:
+    """
+    Fetches the current state of many submissions, one request per node
+    and chunk, and returns the results in the order of `job_ids`.
+    """
+    by_node: Dict[str, List[int]] = {}
+    for index, job_id in enumerate(job_ids):
+        by_node.setdefault(split_job_id(job_id)[0], []).append(index)
+
+    async def get_chunk(indices: List[int]) -> List[Tuple[int, dict]]:
+        node, _ = _node_for(job_ids[indices[0]])
+        tokens = [split_job_id(job_ids[i])[1] for i in indices]
+        response = await node.request(
+            "GET",
+            "/submissions/batch",
+            params={"tokens": ",".join(tokens), "base64_encoded": "false", "fields": RESULT_FIELDS},
+        )
+        if response.status_code != 200:
+            raise Judge0Error("Failed to fetch batch", response.status_code)
+        return list(zip(indices, response.json()["submissions"]))
+
+    chunks = [
+        indices[i:i + BATCH_SIZE]
+        for indices in by_node.values()
+        for i in range(0, len(indices), BATCH_SIZE)
+    ]
+    results: List[Optional[dict]] = [None] * len(job_ids)
+    for chunk_results in await asyncio.gather(*(get_chunk(chunk) for chunk in chunks)):
+        for index, result in chunk_results:
+            results[index] = result
+    return results
+
+
+async def iter_batch_results(job_ids: List[str], timeout: float = RESULT_TIMEOUT) -> AsyncIterator[Tuple[int, dict]]:
+    """
+    Yields (index, result) for each submission as soon as it finishes.
+
+    Only still-pending submissions are re-polled, with the same backoff as
+    wait_for_result.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = POLL_INITIAL_DELAY
+    pending = dict(enumerate(job_ids))
+    started = time.perf_counter()
+    metrics.JUDGE0_IN_FLIGHT.inc(len(pending))
+    try:
+        while pending:
+            indices = list(pending)
+            results = await get_batch([pending[i] for i in indices])
+            for index, result in zip(indices, results):
+                if is_finished(result):
+                    del pending[index]
+                    metrics.JUDGE0_IN_FLIGHT.dec()
+                    metrics.observe_judge0(result, time.perf_counter() - started)
+                    yield index, result
+            if not pending:
+                return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise Judge0Error("Timed out waiting for execution results", 504)
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, POLL_MAX_DELAY)
+    finally:
+        # Cancelled, closed early or timed out: nobody will read the rest.
+        metrics.JUDGE0_IN_FLIGHT.dec(len(pending))
+        abandon_later(pending.values())
+
+
+async def submit_code(source_code: str, language_id: int, stdin: str = "", use_cache: bool = True):
+    """
+    Sends the source code to Judge0 for execution and returns the result.
+
+    With JUDGE0_RESULT_CACHE=1 a repeat of the same program, input and
+    limits is answered from the result cache; pass use_cache=False for
+    programs whose output is not deterministic.
+    """
+    payload = build_payload(source_code, language_id, stdin)
+    cached = cached_result(payload, use_cache)
+    if cached is not None:
+        return cached
+    job_id = None
+    started = time.perf_counter()
+    metrics.JUDGE0_IN_FLIGHT.inc()
+    try:
+        with metrics.timed("judge0_submit"):
+            job_id = await create_submission(source_code, language_id, stdin, payload=payload)
+        with metrics.timed("judge0_wait"):
+            result = await wait_for_result(job_id)
+        metrics.observe_judge0(result, time.perf_counter() - started)
+        store_result(payload, result, use_cache)
+        return result
+    except asyncio.CancelledError:
+        # The client disconnected: stop polling and free the submission.
+        if job_id is not None:
+            abandon_later([job_id])
+        raise
+    except Judge0Error as e:
+        if e.status_code == 504 and job_id is not None:
+            abandon_later([job_id])
+        return {"error": str(e), "status_code": e.status_code}
+    except httpx.HTTPError as e:
+        return {"error": f"Judge0 is unreachable: {e}"}
+    finally:
+        metrics.JUDGE0_IN_FLIGHT.dec()
+
+
+def cancel_status() -> dict:
+    return {**cancel_stats, "pending_deletes": len(_abandoned)}
+
+
+def pool_status() -> dict:
+    """Per-node breaker state, outstanding requests, queue depth and latency."""
+    return pool.snapshot()
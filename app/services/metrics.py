@@ -0,0 +1,186 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+)
+
+# Adds a Server-Timing header with the stages that finished before the
+# response headers were sent (auth, cache lookups, Firestore reads, ...).
+# Streaming responses send their headers early, so provider and Judge0
+# time only shows up in /metrics for them.
+METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "0") == "1"
+# Set by prometheus_client's multiprocess mode when running several workers.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "xenai_http_request_seconds", "Time from receiving a request to the end of its response body.",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge("xenai_http_in_flight", "Requests being handled.", multiprocess_mode="livesum")
+
+STAGE_SECONDS = Histogram(
+    "xenai_stage_seconds", "Duration of one stage of handling a request.", ["stage"], buckets=LATENCY_BUCKETS,
+)
+AUTH_VERIFY_SECONDS = Histogram(
+    "xenai_auth_verify_seconds", "Firebase ID token verification, by how the token was verified.",
+    ["result"], buckets=LATENCY_BUCKETS,
+)
+REVIEW_CACHE_LOOKUPS = Counter("xenai_review_cache_lookups_total", "Review cache lookups.", ["result"])
+
+PROVIDER_QUEUE_SECONDS = Histogram(
+    "xenai_provider_queue_seconds", "Time waiting for a provider concurrency slot.",
+    ["provider"], buckets=LATENCY_BUCKETS,
+)
+PROVIDER_TTFT_SECONDS = Histogram(
+    "xenai_provider_ttft_seconds", "Time from sending a prompt to the first streamed token.",
+    ["provider"], buckets=LATENCY_BUCKETS,
+)
+PROVIDER_SECONDS = Histogram(
+    "xenai_provider_seconds", "Time from sending a prompt to the end of the response.",
+    ["provider", "outcome"], buckets=LATENCY_BUCKETS,
+)
+PROVIDER_TOKENS_PER_SECOND = Histogram(
+    "xenai_provider_tokens_per_second", "Generation speed after the first token (estimated tokens).",
+    ["provider"], buckets=(5, 10, 20, 40, 80, 160, 320, 640, 1280),
+)
+PROVIDER_IN_FLIGHT = Gauge(
+    "xenai_provider_in_flight", "Provider calls holding a concurrency slot.",
+    ["provider"], multiprocess_mode="livesum",
+)
+
+JUDGE0_QUEUE_SECONDS = Histogram(
+    "xenai_judge0_queue_seconds", "Submission turnaround minus Judge0's reported wall time.",
+    buckets=LATENCY_BUCKETS,
+)
+JUDGE0_TURNAROUND_SECONDS = Histogram(
+    "xenai_judge0_turnaround_seconds", "Time from submitting code to having its result.",
+    buckets=LATENCY_BUCKETS,
+)
+JUDGE0_TIME_SECONDS = Histogram(
+    "xenai_judge0_time_seconds", "CPU time Judge0 reports for a submission.",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0),
+)
+JUDGE0_MEMORY_KB = Histogram(
+    "xenai_judge0_memory_kb", "Memory Judge0 reports for a submission, in KB.",
+    buckets=(1024, 4096, 8192, 16384, 32768, 65536, 131072, 262144),
+)
+JUDGE0_IN_FLIGHT = Gauge(
+    "xenai_judge0_in_flight", "Submissions waiting for their result.", multiprocess_mode="livesum",
+)
+JUDGE0_QUEUE_DEPTH = Gauge(
+    "xenai_judge0_queue_depth", "Submissions queued on a Judge0 node at its last health probe.",
+    ["node"], multiprocess_mode="max",
+)
+
+# Stage timings of the current request, for the Server-Timing header.
+_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "server_timings", default=None
+)
+
+
+def add_timing(name: str, seconds: float):
+    """Adds an entry to the current request's Server-Timing header, if enabled."""
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    add_timing(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    """Records the duration of the enclosed block as `stage`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def _number(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def observe_judge0(result: dict, turnaround: Optional[float] = None):
+    """Records Judge0's reported time/memory for a finished submission and, if known, its turnaround."""
+    cpu_time = _number(result.get("time"))
+    memory = _number(result.get("memory"))
+    if cpu_time is not None:
+        JUDGE0_TIME_SECONDS.observe(cpu_time)
+    if memory is not None:
+        JUDGE0_MEMORY_KB.observe(memory)
+    if turnaround is not None:
+        JUDGE0_TURNAROUND_SECONDS.observe(turnaround)
+        wall_time = _number(result.get("wall_time"))
+        if wall_time is not None:
+            JUDGE0_QUEUE_SECONDS.observe(max(0.0, turnaround - wall_time))
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """The Prometheus exposition body and its content type."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request and, with METRICS_SERVER_TIMING=1, reports
+    the request's stage timings in a Server-Timing header.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streaming responses and
+    disconnect detection pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        token = _timings.set([] if METRICS_SERVER_TIMING else None)
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings = _timings.get()
+                if timings is not None:
+                    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings]
+                    entries.append(f"app;dur={(time.perf_counter() - started) * 1000:.1f}")
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", ", ".join(entries).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            _timings.reset(token)
+            # The route template, not the raw path, keeps label cardinality bounded.
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(
+                time.perf_counter() - started
+            )
@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import zipfile
+from typing import AsyncIterator, BinaryIO, List, Optional, Tuple
+
+from firebase_client import async_transactional, server_timestamp
+
+from services import project_index
+from services.file_store import content_hash, file_ref
+from services.firestore_bulk import set_documents
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+ARCHIVE_MAX_EXPORT_BYTES = int(float(os.getenv("ARCHIVE_MAX_EXPORT_MB", "50")) * MB)
+ARCHIVE_MAX_UPLOAD_BYTES = int(float(os.getenv("ARCHIVE_MAX_UPLOAD_MB", "20")) * MB)
+ARCHIVE_MAX_UNCOMPRESSED_BYTES = int(float(os.getenv("ARCHIVE_MAX_UNCOMPRESSED_MB", "50")) * MB)
+ARCHIVE_MAX_FILES = int(os.getenv("ARCHIVE_MAX_FILES", "2000"))
+# Firestore documents are capped at 1 MiB including field names.
+ARCHIVE_MAX_FILE_BYTES = int(os.getenv("ARCHIVE_MAX_FILE_KB", "900")) * 1024
+EXPORT_PAGE_SIZE = 50
+
+# Names Firestore does not allow as a document id (and nested paths).
+_INVALID_NAME = re.compile(r"^(\.|\.\.|__.*__)$|/")
+
+archive_stats = {
+    "exports": 0,
+    "export_files": 0,
+    "export_bytes": 0,
+    "export_seconds": 0.0,
+    "imports": 0,
+    "import_files": 0,
+    "import_bytes": 0,
+    "import_seconds": 0.0,
+    "rejected": 0,
+}
+
+
+class ArchiveError(Exception):
+    """An archive was rejected (too large, malformed, ...)."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _ZipSink:
+    """
+    Write-only target for ZipFile. It has no `tell`/`seek`, so zipfile
+    falls back to streaming mode (data descriptors after each entry) and
+    the bytes can be handed out as soon as they are produced.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def _zip_time(value) -> Tuple[int, int, int, int, int, int]:
+    stamp = value.timetuple()[:6] if hasattr(value, "timetuple") else time.localtime()[:6]
+    # The zip format cannot represent dates before 1980.
+    return stamp if stamp[0] >= 1980 else (1980, 1, 1, 0, 0, 0)
+
+
+def folder_size(index: dict, folder: str) -> Optional[int]:
+    """Total size of a folder according to the project index, or None if it does not exist."""
+    entry = index.get("folders", {}).get(folder)
+    if entry is None:
+        return None
+    return sum((meta or {}).get("size") or 0 for meta in entry.get("files", {}).values())
+
+
+async def export_folder(db, user_id: str, folder: str) -> AsyncIterator[bytes]:
+    """
+    Streams a folder as a zip archive.
+
+    Documents are read a page at a time, the next page being fetched
+    while the current one is compressed, and every entry is yielded as
+    soon as it is written, so memory stays bounded by one page.
+    """
+    query = (
+        db.collection("users").document(user_id).collection(folder)
+        .select(["content", "last_modified"])
+        .order_by("__name__")
+        .limit(EXPORT_PAGE_SIZE)
+    )
+
+    async def fetch(after):
+        page_query = query.start_after(after) if after is not None else query
+        return [doc async for doc in page_query.stream()]
+
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED)
+    started = time.perf_counter()
+    files = total = 0
+    next_page = asyncio.create_task(fetch(None))
+    try:
+        while True:
+            docs = await next_page
+            if len(docs) == EXPORT_PAGE_SIZE:
+                next_page = asyncio.create_task(fetch(docs[-1]))
+            else:
+                next_page = None
+            for doc in docs:
+                if doc.id == project_index.LEGACY_MARKER:
+                    continue
+                data = doc.to_dict() or {}
+                content = (data.get("content") or "").encode("utf-8")
+                total += len(content)
+                if total > ARCHIVE_MAX_EXPORT_BYTES:
+                    # The index under-reported the size; abort rather than exceed the limit.
+                    raise ArchiveError("Folder is too large to export", 413)
+                archive.writestr(zipfile.ZipInfo(doc.id, _zip_time(data.get("last_modified"))), content,
+                                 compress_type=zipfile.ZIP_DEFLATED)
+                files += 1
+                yield sink.drain()
+            if next_page is None:
+                break
+        archive.close()
+        yield sink.drain()
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+        elapsed = time.perf_counter() - started
+        archive_stats["exports"] += 1
+        archive_stats["export_files"] += files
+        archive_stats["export_bytes"] += total
+        archive_stats["export_seconds"] += elapsed
+        logger.info(f"Exported {files} files ({total} bytes) from '{folder}' in {elapsed:.2f}s")
+
+
+def _common_root(names: List[str]) -> str:
+    """A single top-level directory shared by every entry ("project/"), or ""."""
+    roots = {name.split("/", 1)[0] for name in names}
+    if len(roots) == 1 and all("/" in name for name in names):
+        return roots.pop() + "/"
+    return ""
+
+
+def read_archive(fileobj: BinaryIO) -> Tuple[List[Tuple[str, str]], List[dict]]:
+    """
+    Unpacks an uploaded zip into (filename, text) pairs, enforcing the
+    entry-count and size limits on both the declared and the actual
+    uncompressed sizes. Entries that cannot become a file (nested paths,
+    binary content, oversized) are returned as skipped with a reason.
+    Blocking; run it in a thread.
+    """
+    fileobj.seek(0, os.SEEK_END)
+    if fileobj.tell() > ARCHIVE_MAX_UPLOAD_BYTES:
+        raise ArchiveError("Archive is too large", 413)
+    fileobj.seek(0)
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise ArchiveError("Upload is not a valid zip archive")
+
+    with archive:
+        entries = [info for info in archive.infolist() if not info.is_dir()]
+        if len(entries) > ARCHIVE_MAX_FILES:
+            raise ArchiveError(f"Archive has more than {ARCHIVE_MAX_FILES} files", 413)
+        if sum(info.file_size for info in entries) > ARCHIVE_MAX_UNCOMPRESSED_BYTES:
+            raise ArchiveError("Archive is too large when uncompressed", 413)
+
+        root = _common_root([info.filename for info in entries])
+        files, skipped = [], []
+        total = 0
+        for info in entries:
+            name = info.filename[len(root):]
+            if _INVALID_NAME.search(name) or not name:
+                skipped.append({"name": info.filename, "reason": "nested or invalid path"})
+                continue
+            if info.file_size > ARCHIVE_MAX_FILE_BYTES:
+                skipped.append({"name": info.filename, "reason": "file too large"})
+                continue
+            with archive.open(info) as member:
+                # Never trust the declared size: read at most one byte past the limit.
+                raw = member.read(ARCHIVE_MAX_FILE_BYTES + 1)
+            if len(raw) > ARCHIVE_MAX_FILE_BYTES:
+                skipped.append({"name": info.filename, "reason": "file too large"})
+                continue
+            total += len(raw)
+            if total > ARCHIVE_MAX_UNCOMPRESSED_BYTES:
+                raise ArchiveError("Archive is too large when uncompressed", 413)
+            try:
+                files.append((name, raw.decode("utf-8")))
+            except UnicodeDecodeError:
+                skipped.append({"name": info.filename, "reason": "not UTF-8 text"})
+    return files, skipped
+
+
+async def import_folder(db, user_id: str, folder: str, fileobj: BinaryIO) -> dict:
+    """
+    Unpacks a zip into a folder with batched writes, then records every
+    file in the project index in one transaction. Files whose content hash
+    matches the index are not rewritten.
+    """
+    started = time.perf_counter()
+    try:
+        files, skipped = await asyncio.to_thread(read_archive, fileobj)
+    except ArchiveError:
+        archive_stats["rejected"] += 1
+        raise
+
+    await project_index.ensure_index(db, user_id)
+    index = await project_index.load_index(db, user_id)
+    writes, metas = [], {}
+    unchanged = 0
+    for filename, content in files:
+        size = len(content.encode("utf-8"))
+        digest = content_hash(content)
+        current = project_index.file_entry(index, folder, filename)
+        if current and current.get("hash") == digest:
+            unchanged += 1
+            continue
+        writes.append((file_ref(db, user_id, folder, filename), {
+            "content": content,
+            "filename": filename,
+            "folder": folder,
+            "size": size,
+            "content_hash": digest,
+            "last_modified": server_timestamp()
+        }, size))
+        metas[filename] = project_index.file_meta(size, digest)
+
+    # Check the index has room before any file is written.
+    for filename, meta in metas.items():
+        project_index.put_file(index, folder, filename, meta)
+    if project_index.estimate_size(index) > project_index.INDEX_MAX_BYTES:
+        raise project_index.IndexFull("Project has too many files")
+
+    written = await set_documents(db, writes)
+
+    @async_transactional
+    async def record(transaction):
+        current = await project_index.read_in_transaction(db, user_id, transaction)
+        if not project_index.folder_exists(current, folder):
+            project_index.add_folder(current, folder)
+        for filename, meta in metas.items():
+            project_index.put_file(current, folder, filename, meta)
+        project_index.write_in_transaction(db, user_id, transaction, current)
+
+    await record(db.transaction())
+
+    elapsed = time.perf_counter() - started
+    imported_bytes = sum(size for _, _, size in writes)
+    archive_stats["imports"] += 1
+    archive_stats["import_files"] += written
+    archive_stats["import_bytes"] += imported_bytes
+    archive_stats["import_seconds"] += elapsed
+    return {
+        "written": written,
+        "unchanged": unchanged,
+        "skipped": skipped,
+        "files": [filename for filename, _ in files],
+        "bytes": imported_bytes,
+        "seconds": round(elapsed, 3),
+        "mb_per_second": round(imported_bytes / MB / elapsed, 2) if elapsed else None,
+    }
+
+
+def archive_status() -> dict:
+    def rate(byte_key, second_key):
+        seconds = archive_stats[second_key]
+        return round(archive_stats[byte_key] / MB / seconds, 2) if seconds else None
+
+    return {
+        **archive_stats,
+        "export_mb_per_second": rate("export_bytes", "export_seconds"),
+        "import_mb_per_second": rate("import_bytes", "import_seconds"),
+    }
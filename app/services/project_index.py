@@ -0,0 +1,157 @@
+from typing import Optional
+
+from firebase_client import field_path, server_timestamp
+
+# One document per user: {"folders": {folder: {"created": ts, "files": {filename: meta}}}, "bytes": n}
+# where `bytes` is the estimated document size.
+INDEX_COLLECTION = "project_index"
+LEGACY_MARKER = ".marker"
+# Leave room under Firestore's 1 MiB document limit.
+INDEX_MAX_BYTES = 900 * 1024
+# Default for file_meta: stamp the entry with the server time of the write.
+_NOW = object()
+
+
+class IndexMissing(Exception):
+    """The user has no index document yet; backfill it and retry."""
+
+
+class IndexFull(Exception):
+    """The change would take the index document over INDEX_MAX_BYTES."""
+
+
+def index_ref(db, user_id: str):
+    return db.collection(INDEX_COLLECTION).document(user_id)
+
+
+def empty_index() -> dict:
+    return {"folders": {}}
+
+
+def estimate_size(value) -> int:
+    """Firestore's storage size of a value, close enough to guard the document limit."""
+    if isinstance(value, dict):
+        return sum(len(key.encode("utf-8")) + 1 + estimate_size(item) for key, item in value.items())
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if value is None:
+        return 1
+    return 8
+
+
+def file_meta(size: Optional[int], content_hash: Optional[str], mtime=_NOW) -> dict:
+    return {"size": size, "hash": content_hash, "mtime": server_timestamp() if mtime is _NOW else mtime}
+
+
+async def _backfill(db, user_id: str) -> dict:
+    """Builds the index for a user whose project predates it, by enumerating once."""
+    index = empty_index()
+    user_doc = db.collection("users").document(user_id)
+    async for collection in user_doc.collections():
+        files = {}
+        async for doc in collection.select(["size", "content_hash", "last_modified"]).stream():
+            if doc.id == LEGACY_MARKER:
+                continue
+            data = doc.to_dict()
+            files[doc.id] = file_meta(data.get("size"), data.get("content_hash"), data.get("last_modified"))
+        index["folders"][collection.id] = {"created": server_timestamp(), "files": files}
+    index["bytes"] = estimate_size(index)
+    await index_ref(db, user_id).set(index)
+    return index
+
+
+async def ensure_index(db, user_id: str):
+    """Makes sure the index document exists before a transaction reads it."""
+    snapshot = await index_ref(db, user_id).get()
+    if not snapshot.exists:
+        await _backfill(db, user_id)
+
+
+async def load_index(db, user_id: str) -> dict:
+    """The whole project tree in a single document read."""
+    snapshot = await index_ref(db, user_id).get()
+    if not snapshot.exists:
+        return await _backfill(db, user_id)
+    return snapshot.to_dict() or empty_index()
+
+
+async def read_in_transaction(db, user_id: str, transaction) -> dict:
+    snapshot = await index_ref(db, user_id).get(transaction=transaction)
+    return (snapshot.to_dict() if snapshot.exists else None) or empty_index()
+
+
+async def read_entry_in_transaction(db, user_id: str, folder: str, filename: str, transaction) -> dict:
+    """
+    The index trimmed to one file's entry, its folder's creation time and
+    the document size, so a save does not read the whole tree. Raises
+    IndexMissing when the user has no index document yet.
+    """
+    ref = index_ref(db, user_id)
+    snapshot = await ref.get(field_paths=[
+        field_path("folders", folder, "created"), field_path("folders", folder, "files", filename), "bytes",
+    ], transaction=transaction)
+    if not snapshot.exists:
+        raise IndexMissing(user_id)
+    index = snapshot.to_dict() or empty_index()
+    if "bytes" not in index:
+        # Written before sizes were recorded: size it from one full read.
+        full = await ref.get(transaction=transaction)
+        index["bytes"] = estimate_size(full.to_dict() or {})
+    return index
+
+
+def put_entry_in_transaction(db, user_id: str, transaction, index: dict, folder: str, filename: str, meta: dict):
+    """
+    Writes one file entry of an index read by read_entry_in_transaction
+    with a field-path update, leaving the rest of the document untouched.
+    """
+    updates = {}
+    growth = 0
+    if not folder_exists(index, folder):
+        updates[field_path("folders", folder, "created")] = server_timestamp()
+        growth += estimate_size({folder: {"created": None, "files": {}}})
+    if file_entry(index, folder, filename) is None:
+        growth += estimate_size({filename: meta})
+    size = index.get("bytes", 0) + growth
+    if growth and size > INDEX_MAX_BYTES:
+        raise IndexFull("Project has too many files")
+    updates[field_path("folders", folder, "files", filename)] = meta
+    updates["bytes"] = size
+    transaction.update(index_ref(db, user_id), updates)
+
+
+def put_file(index: dict, folder: str, filename: str, meta: dict):
+    folders = index.setdefault("folders", {})
+    entry = folders.setdefault(folder, {"created": server_timestamp(), "files": {}})
+    entry.setdefault("files", {})[filename] = meta
+
+
+def file_entry(index: dict, folder: str, filename: str) -> Optional[dict]:
+    return index.get("folders", {}).get(folder, {}).get("files", {}).get(filename)
+
+
+def drop_file(index: dict, folder: str, filename: str):
+    entry = index.get("folders", {}).get(folder)
+    if entry is not None:
+        entry.get("files", {}).pop(filename, None)
+
+
+def folder_exists(index: dict, folder: str) -> bool:
+    return folder in index.get("folders", {})
+
+
+def add_folder(index: dict, folder: str):
+    index.setdefault("folders", {})[folder] = {"created": server_timestamp(), "files": {}}
+
+
+def drop_folder(index: dict, folder: str):
+    index.get("folders", {}).pop(folder, None)
+
+
+def write_in_transaction(db, user_id: str, transaction, index: dict):
+    """Replaces the whole index document. Changes that shrink it are always allowed."""
+    size = estimate_size({**index, "bytes": 0})
+    if size > INDEX_MAX_BYTES and size > index.get("bytes", 0):
+        raise IndexFull("Project has too many files")
+    index["bytes"] = size
+    transaction.set(index_ref(db, user_id), index)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request
+
+from services.cache import TTLCache, get_redis
+from services.firebase_auth import optional_firebase_user
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_REDIS = os.getenv("RATE_LIMIT_REDIS", "0") == "1"
+REDIS_KEY_PREFIX = "xenai:ratelimit:"
+
+# Atomic token bucket: KEYS[1] = bucket, ARGV = rate, capacity, cost, now.
+# Returns {allowed, milliseconds until `cost` tokens are available}.
+_REDIS_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait_ms = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  wait_ms = math.ceil((cost - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, wait_ms}
+"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self, cost: float = 1.0) -> Tuple[bool, float]:
+        """Take `cost` tokens if possible; otherwise return the seconds until they are."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True, 0.0
+        return False, (cost - self.tokens) / self.rate
+
+
+class RateLimited(HTTPException):
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+class Limiter:
+    """
+    Per-user and global admission control for one class of work.
+
+    A request first needs a token from its caller's bucket; an empty user
+    bucket is rejected straight away. It then needs a token from the
+    global bucket, and may wait for one in a bounded queue for at most
+    `max_wait` seconds. When the queue is full or the wait would exceed
+    the deadline the request is rejected with 429 and Retry-After rather
+    than parked as another coroutine. With RATE_LIMIT_REDIS=1 the buckets
+    live in Redis so limits hold across workers.
+    """
+
+    def __init__(self, name: str, user_rate: float, user_burst: float,
+                 global_rate: float, global_burst: float, max_queue: int, max_wait: float):
+        self.name = name
+        self.user_rate = _env_float(name, "USER_RATE", user_rate)
+        self.user_burst = _env_float(name, "USER_BURST", user_burst)
+        self.global_rate = _env_float(name, "GLOBAL_RATE", global_rate)
+        self.global_burst = _env_float(name, "GLOBAL_BURST", global_burst)
+        self.max_queue = int(_env_float(name, "MAX_QUEUE", max_queue))
+        self.max_wait = _env_float(name, "MAX_WAIT", max_wait)
+        self._user_buckets = TTLCache(maxsize=100_000, ttl=max(60.0, self.user_burst / self.user_rate))
+        self._global_bucket = TokenBucket(self.global_rate, self.global_burst)
+        self._waiting = 0
+        self.stats: Dict[str, int] = {"admitted": 0, "queued": 0, "rejected_user": 0, "rejected_global": 0}
+        self.redis = None
+
+    async def start(self, redis=None):
+        self.redis = redis
+
+    async def _take(self, key: str, rate: float, capacity: float, cost: float) -> Tuple[bool, float]:
+        if self.redis is not None:
+            try:
+                allowed, wait_ms = await self.redis.eval(
+                    _REDIS_BUCKET_SCRIPT, 1, REDIS_KEY_PREFIX + key, rate, capacity, cost, time.time()
+                )
+                return bool(allowed), wait_ms / 1000
+            except Exception as e:
+                logger.warning(f"Rate limiter Redis call failed, using local buckets: {e}")
+        if key == self._global_key:
+            return self._global_bucket.try_acquire(cost)
+        bucket = self._user_buckets.get(key) or TokenBucket(rate, capacity)
+        # Re-setting refreshes the TTL, so only idle (hence full) buckets are evicted.
+        self._user_buckets.set(key, bucket)
+        return bucket.try_acquire(cost)
+
+    @property
+    def _global_key(self) -> str:
+        return f"{self.name}:global"
+
+    async def acquire(self, caller: str, cost: float = 1.0):
+        """
+        Admit one request costing `cost` tokens or raise RateLimited. A cost
+        above the user burst could never be admitted, so it gets 413 instead.
+        """
+        if cost > self.user_burst:
+            self.stats["rejected_user"] += 1
+            raise HTTPException(
+                status_code=413,
+                detail=f"Request is too large: it costs {cost:g} units and the per-user limit is {self.user_burst:g}.",
+            )
+        ok, retry_after = await self._take(f"{self.name}:user:{caller}", self.user_rate, self.user_burst, cost)
+        if not ok:
+            self.stats["rejected_user"] += 1
+            raise RateLimited("Too many requests. Please slow down.", retry_after)
+
+        global_cost = min(cost, self.global_burst)
+        ok, retry_after = await self._take(self._global_key, self.global_rate, self.global_burst, global_cost)
+        if ok:
+            self.stats["admitted"] += 1
+            return
+        if self._waiting >= self.max_queue or retry_after > self.max_wait:
+            self.stats["rejected_global"] += 1
+            raise RateLimited("Server is busy. Please retry shortly.", retry_after)
+
+        self._waiting += 1
+        self.stats["queued"] += 1
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while True:
+                await asyncio.sleep(retry_after)
+                ok, retry_after = await self._take(self._global_key, self.global_rate, self.global_burst, global_cost)
+                if ok:
+                    self.stats["admitted"] += 1
+                    return
+                if time.monotonic() + retry_after > deadline:
+                    self.stats["rejected_global"] += 1
+                    raise RateLimited("Server is busy. Please retry shortly.", retry_after)
+        finally:
+            self._waiting -= 1
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "waiting": self._waiting, "max_queue": self.max_queue,
+                "redis": self.redis is not None}
+
+
+def _env_float(name: str, setting: str, default: float) -> float:
+    value = os.getenv(f"RATE_LIMIT_{name.upper()}_{setting}")
+    return float(value) if value else default
+
+
+def caller_key(request: Request, user: Optional[dict]) -> str:
+    """Firebase uid when authenticated, otherwise the client address."""
+    if user and user.get("uid"):
+        return f"uid:{user['uid']}"
+    client = request.client.host if request.client else "unknown"
+    return f"ip:{client}"
+
+
+ai_limiter = Limiter("ai", user_rate=0.2, user_burst=5, global_rate=5, global_burst=20,
+                     max_queue=50, max_wait=10)
+exec_limiter = Limiter("exec", user_rate=1, user_burst=10, global_rate=20, global_burst=40,
+                       max_queue=100, max_wait=5)
+
+limiters = [ai_limiter, exec_limiter]
+
+
+async def start_limiters():
+    if not RATE_LIMIT_REDIS:
+        return
+    client = get_redis()
+    for limiter in limiters:
+        await limiter.start(client)
+
+
+async def stop_limiters():
+    # The shared client itself is closed by cache.close_redis.
+    for limiter in limiters:
+        limiter.redis = None
+
+
+async def limit_exec(request: Request, user: Optional[dict] = Depends(optional_firebase_user)):
+    """Dependency: admission control for code execution routes."""
+    await exec_limiter.acquire(caller_key(request, user))
+
+
+def limiter_status() -> dict:
+    return {limiter.name: limiter.snapshot() for limiter in limiters}
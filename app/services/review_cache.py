@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+from typing import Optional
+
+from services.cache import TTLCache, get_redis, redis_url
+
+logger = logging.getLogger(__name__)
+
+REVIEW_CACHE_SIZE = int(os.getenv("REVIEW_CACHE_SIZE", "1024"))
+REVIEW_CACHE_TTL = int(os.getenv("REVIEW_CACHE_TTL", "3600"))
+REVIEW_CACHE_REDIS = os.getenv("REVIEW_CACHE_REDIS", "0") == "1"
+REDIS_KEY_PREFIX = "xenai:review:"
+
+
+def normalize_code(code: str) -> str:
+    """Normalize line endings and trailing whitespace so cosmetic resubmits share a key."""
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def review_key(code: str, service_choice: str, prompt_version: str) -> str:
+    digest = hashlib.sha256()
+    for part in (prompt_version, service_choice, normalize_code(code)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ReviewCache:
+    """
+    Two-tier cache of finished reviews.
+
+    The local tier is a per-worker TTL/LRU; the optional Redis tier
+    (REVIEW_CACHE_REDIS=1) lets every uvicorn worker share hits. Redis
+    errors are logged and treated as misses so a cache outage never fails
+    a review.
+    """
+
+    def __init__(self, maxsize: int = REVIEW_CACHE_SIZE, ttl: int = REVIEW_CACHE_TTL):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.redis = None
+        self.stats = {"hits_local": 0, "hits_redis": 0, "misses": 0, "stores": 0, "redis_errors": 0}
+
+    async def start(self):
+        if not REVIEW_CACHE_REDIS or self.redis is not None:
+            return
+        self.redis = get_redis()
+        logger.info("Review cache using Redis at %s", redis_url())
+
+    async def aclose(self):
+        # The shared client itself is closed by cache.close_redis.
+        self.redis = None
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["hits_local"] += 1
+            return value
+        if self.redis is not None:
+            try:
+                value = await self.redis.get(REDIS_KEY_PREFIX + key)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning(f"Review cache Redis read failed: {e}")
+                value = None
+            if value is not None:
+                self.stats["hits_redis"] += 1
+                self.local.set(key, value)
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    async def prefetch(self, key: str) -> bool:
+        """
+        Whether a review is cached, without counting a hit or a miss. A
+        Redis hit is copied to the local tier for the `get` that follows.
+        """
+        if self.local.get(key) is not None:
+            return True
+        if self.redis is None:
+            return False
+        try:
+            value = await self.redis.get(REDIS_KEY_PREFIX + key)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Review cache Redis read failed: {e}")
+            return False
+        if value is None:
+            return False
+        self.local.set(key, value)
+        return True
+
+    async def set(self, key: str, review: str):
+        self.local.set(key, review)
+        self.stats["stores"] += 1
+        if self.redis is not None:
+            try:
+                await self.redis.set(REDIS_KEY_PREFIX + key, review, ex=self.ttl)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning(f"Review cache Redis write failed: {e}")
+
+    def snapshot(self) -> dict:
+        hits = self.stats["hits_local"] + self.stats["hits_redis"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "local_entries": len(self.local),
+            "redis_enabled": self.redis is not None,
+        }
+
+
+review_cache = ReviewCache()
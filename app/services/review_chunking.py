@@ -0,0 +1,125 @@
+import math
+import os
+import re
+from typing import List, NamedTuple
+
+# Rough chars-per-token for source code across the providers' tokenizers.
+# Deliberately low so estimates err on the large side.
+CHARS_PER_TOKEN = 3.5
+
+# Inputs above this are split; each chunk stays within it.
+REVIEW_CHUNK_TOKENS = int(os.getenv("REVIEW_CHUNK_TOKENS", "3000"))
+# Largest input accepted for review at all.
+REVIEW_MAX_INPUT_TOKENS = int(os.getenv("REVIEW_MAX_INPUT_TOKENS", "60000"))
+# Budget for the file outline sent along with every chunk.
+OUTLINE_TOKENS = 300
+
+# Top-level definitions in the languages Judge0 runs most often.
+_DEFINITION = re.compile(
+    r"^(async\s+def|def|class|function|func|fn|pub\s|impl|struct|enum|interface|trait|type\s|"
+    r"public|private|protected|static|export|const\s+\w+\s*=\s*(async\s*)?\(|@)"
+)
+
+
+class Chunk(NamedTuple):
+    index: int
+    start_line: int  # 1-based, inclusive
+    end_line: int
+    text: str
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+# Top-level blocks whose members are split like top-level definitions:
+# Java keeps the whole program inside one `class Main`, so its methods are
+# the only boundaries there are.
+_CONTAINER = re.compile(r"^(\w+\s+)*(class|struct|impl|interface|trait|enum|object|namespace|module)\b")
+
+# Lines that belong to the definition below them (annotations, comments, doc comments).
+_ATTACHED = ("@", "#", "//", "/*", "*")
+
+
+def _starts_unit(lines: List[str], i: int) -> bool:
+    """A line, at its block's member indentation, where a new unit can start."""
+    line = lines[i].lstrip()
+    if _DEFINITION.match(line):
+        # Keep decorators, annotations and doc comments attached to what they describe.
+        previous = lines[i - 1].strip() if i > 0 else ""
+        return i == 0 or not (previous.startswith(_ATTACHED) or previous.endswith("*/"))
+    # Any other line after a blank line (top-level statements, brace languages).
+    return i > 0 and not lines[i - 1].strip()
+
+
+def _segments(lines: List[str]) -> List[range]:
+    starts = [0]
+    # Indentation of the members of the current top-level container; 0 = not yet seen.
+    member_indent = None
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        indent = len(line) - len(line.lstrip())
+        if indent == 0:
+            if member_indent == 0 and line.strip() == "{":
+                continue  # Allman-style opening brace of the container
+            if i > 0 and _starts_unit(lines, i):
+                starts.append(i)
+            member_indent = 0 if _CONTAINER.match(line[:200]) else None
+        elif member_indent == 0:
+            # First line inside the container; it stays with the header.
+            member_indent = indent
+        elif indent == member_indent and _starts_unit(lines, i):
+            starts.append(i)
+    return [range(start, end) for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+
+def split_code(code: str, max_tokens: int = REVIEW_CHUNK_TOKENS) -> List[Chunk]:
+    """
+    Splits source into chunks of at most `max_tokens` (estimated), cutting
+    at top-level function/class boundaries, or between the members of a
+    top-level class, and packing consecutive definitions together. A
+    single definition larger than the budget is cut at line boundaries.
+    """
+    lines = code.splitlines(keepends=True)
+    budget = max_tokens * CHARS_PER_TOKEN
+    spans: List[range] = []
+    for segment in _segments(lines):
+        size = sum(len(lines[i]) for i in segment)
+        if size <= budget:
+            pieces = [segment]
+        else:
+            pieces, start, acc = [], segment.start, 0
+            for i in segment:
+                if acc and acc + len(lines[i]) > budget:
+                    pieces.append(range(start, i))
+                    start, acc = i, 0
+                acc += len(lines[i])
+            pieces.append(range(start, segment.stop))
+        for piece in pieces:
+            if spans:
+                merged = range(spans[-1].start, piece.stop)
+                if sum(len(lines[i]) for i in merged) <= budget:
+                    spans[-1] = merged
+                    continue
+            spans.append(piece)
+
+    return [
+        Chunk(index, span.start + 1, span.stop, "".join(lines[span.start:span.stop]))
+        for index, span in enumerate(spans)
+    ]
+
+
+def outline(code: str, max_tokens: int = OUTLINE_TOKENS) -> str:
+    """Top-level definition lines with their line numbers, trimmed to the budget."""
+    entries = []
+    budget = max_tokens * CHARS_PER_TOKEN
+    for number, line in enumerate(code.splitlines(), start=1):
+        if line and not line[0].isspace() and _DEFINITION.match(line) and not line.startswith("@"):
+            entry = f"{number}: {line.strip()[:120]}"
+            budget -= len(entry) + 1
+            if budget < 0:
+                entries.append("...")
+                break
+            entries.append(entry)
+    return "\n".join(entries)
@@ -0,0 +1,94 @@
+import asyncio
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+
+class _Flight:
+    """One in-flight upstream stream and everything it has produced so far."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._waiter = asyncio.Event()
+
+    def publish(self):
+        waiter, self._waiter = self._waiter, asyncio.Event()
+        waiter.set()
+
+    async def wait(self):
+        await self._waiter.wait()
+
+
+class StreamSingleFlight:
+    """
+    Coalesces identical concurrent streams onto one upstream call.
+
+    The first subscriber for a key starts the upstream stream in a
+    background task; later subscribers attach to it. Every subscriber is
+    first replayed the chunks produced so far and then follows the live
+    stream, so a late joiner never waits longer than the leader does.
+    The flight is forgotten once the upstream finishes; repeat requests
+    after that are the review cache's job. When the last subscriber
+    leaves before the upstream finishes, the upstream is cancelled so no
+    provider keeps generating for nobody.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.stats = {"leaders": 0, "joined": 0, "cancelled": 0, "wasted_chars": 0}
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def subscribe(self, key: Hashable, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["joined"] += 1
+
+        flight.subscribers += 1
+        try:
+            position = 0
+            while True:
+                while position < len(flight.chunks):
+                    yield flight.chunks[position]
+                    position += 1
+                if flight.done:
+                    break
+                await flight.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done and flight.task is not None:
+                # Forget it now so a new request starts a fresh upstream instead of joining a dying one.
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+                self.stats["cancelled"] += 1
+                self.stats["wasted_chars"] += sum(len(chunk) for chunk in flight.chunks)
+
+    async def _run(self, key: Hashable, flight: _Flight, factory: Callable[[], AsyncIterator[str]]):
+        try:
+            async for chunk in factory():
+                flight.chunks.append(chunk)
+                flight.publish()
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("Upstream stream was cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.publish()
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight": self.in_flight()}
@@ -0,0 +1,86 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, TypeVar
+
+from fastapi import Request
+
+# How often an idle handler checks whether its client is still there.
+DISCONNECT_POLL_INTERVAL = 0.5
+# nginx's "client closed request"; nobody reads it, but it shows up in access logs.
+CLIENT_CLOSED_REQUEST = 499
+
+T = TypeVar("T")
+
+disconnect_stats = {"disconnects": 0, "streams_cancelled": 0, "calls_cancelled": 0}
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the response was ready."""
+
+
+async def cancel_on_disconnect(request: Request, stream: AsyncIterator[T]) -> AsyncIterator[T]:
+    """
+    Relays `stream` until the client disconnects, then cancels it.
+
+    A watcher polls `request.is_disconnected()` and cancels the task that
+    is iterating the stream, so the CancelledError lands wherever the
+    stream is waiting (a provider call, a Judge0 poll) and its cleanup
+    runs right away instead of when the generator is garbage collected.
+    """
+    task = asyncio.current_task()
+    disconnected = False
+
+    async def watch():
+        nonlocal disconnected
+        while True:
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+            if await request.is_disconnected():
+                disconnected = True
+                disconnect_stats["disconnects"] += 1
+                task.cancel()
+                return
+
+    watcher = asyncio.create_task(watch())
+    try:
+        async for item in stream:
+            yield item
+    except (asyncio.CancelledError, GeneratorExit) as e:
+        # Usually the server sees the disconnect first and cancels (or closes)
+        # the response itself, before the watcher's next poll; count it either way.
+        disconnect_stats["streams_cancelled"] += 1
+        if not disconnected:
+            disconnect_stats["disconnects"] += 1
+            raise
+        if isinstance(e, GeneratorExit):
+            raise
+        # Nobody is listening; end quietly instead of failing the response task.
+        task.uncancel()
+    finally:
+        watcher.cancel()
+        await stream.aclose()
+
+
+async def run_until_disconnected(request: Request, awaitable: Awaitable[T]) -> T:
+    """
+    Awaits `awaitable` in a task and cancels it if the client disconnects
+    first, raising ClientDisconnected.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                disconnect_stats["disconnects"] += 1
+                disconnect_stats["calls_cancelled"] += 1
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        # The server cancelled the handler itself (client gone or shutdown).
+        disconnect_stats["disconnects"] += 1
+        disconnect_stats["calls_cancelled"] += 1
+        raise
+    finally:
+        if not task.done():
+            task.cancel()
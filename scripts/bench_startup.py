@@ -0,0 +1,120 @@
+"""
+Startup-time benchmark for the API.
+
+Every sample runs in a fresh interpreter, so nothing is cached in
+sys.modules between runs, and reports:
+
+  import_ms   time to `import main` (module imports, app and router setup)
+  startup_ms  time to run the FastAPI lifespan startup, up to readiness
+  ready_ms    the sum: how long a new replica takes before it can serve
+
+Usage (from the repository root):
+
+    python scripts/bench_startup.py                 # 10 runs, summary table
+    python scripts/bench_startup.py --runs 30 --json
+    python scripts/bench_startup.py --importtime 15 # slowest imports (-X importtime)
+
+Run it with the same environment as the server (.env, credentials) to
+measure a real cold start, or without credentials to check that a worker
+still boots. Disk caches are warm after the first run; the first sample
+is reported separately as `first_run`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+# Runs inside the child interpreter; prints one JSON line.
+PROBE = """
+import asyncio, json, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+
+async def run_lifespan():
+    async with main.app.router.lifespan_context(main.app):
+        t2 = time.perf_counter()
+        ready = main.firebase_ready()
+    return t2, ready
+
+t2, ready = asyncio.run(run_lifespan())
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "startup_ms": (t2 - t1) * 1000,
+                  "ready_ms": (t2 - t0) * 1000, "firebase_ready": ready}))
+"""
+
+
+def run_once(python: str) -> dict:
+    env = {**os.environ, "PYTHONPATH": APP_DIR}
+    result = subprocess.run(
+        [python, "-c", PROBE], cwd=APP_DIR, env=env, capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        sys.exit(f"Startup failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(values):
+    ordered = sorted(values)
+    return {
+        "min": round(ordered[0], 1),
+        "median": round(statistics.median(ordered), 1),
+        "p90": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))], 1),
+        "max": round(ordered[-1], 1),
+    }
+
+
+def importtime(python: str, top: int):
+    """Slowest modules by cumulative import time when importing main."""
+    env = {**os.environ, "PYTHONPATH": APP_DIR}
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "import main"], cwd=APP_DIR, env=env, capture_output=True, text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--python", default=sys.executable)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--importtime", type=int, metavar="N", help="show the N slowest imports and exit")
+    args = parser.parse_args()
+
+    if args.importtime:
+        importtime(args.python, args.importtime)
+        return
+
+    samples = [run_once(args.python) for _ in range(args.runs)]
+    first, rest = samples[0], samples[1:] or samples
+    report = {
+        "runs": args.runs,
+        "python": args.python,
+        "firebase_ready": first["firebase_ready"],
+        "first_run": {key: round(first[key], 1) for key in ("import_ms", "startup_ms", "ready_ms")},
+        **{key: summarize([s[key] for s in rest]) for key in ("import_ms", "startup_ms", "ready_ms")},
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.runs} runs, firebase ready: {report['firebase_ready']}")
+    print(f"first run: {report['first_run']}")
+    print(f"{'':12}{'min':>9}{'median':>9}{'p90':>9}{'max':>9}")
+    for key in ("import_ms", "startup_ms", "ready_ms"):
+        row = report[key]
+        print(f"{key:12}{row['min']:9.1f}{row['median']:9.1f}{row['p90']:9.1f}{row['max']:9.1f}")
+
+
+if __name__ == "__main__":
+    main()